@@ -27,13 +27,18 @@ parser = argparse.ArgumentParser(
     description=__doc__,
     formatter_class=argparse.RawTextHelpFormatter)
 parser.add_argument(
-    'action', choices=['create', 'upload', 'process', 'all', 'status'],
+    'action',
+    choices=['create', 'upload', 'process', 'all', 'status', 'logs', 'serve'],
     help=("Action to perform. Choices: %(choices)s\n"
           "create: creates the request\n"
           "upload: upload the database\n"
           "process: actualy perform the database upgrade\n"
           "all: do the 3 previous operations in one go\n"
           "status: display the current status of your upgrade request\n"
+          "        (of several requests at once with --batch)\n"
+          "logs: display the log of your upgrade request\n"
+          "serve: run an agent performing the above actions as jobs\n"
+          "       submitted to a local HTTP endpoint\n"
           ), action='store',
     metavar='ACTION')
 parser.add_argument(
@@ -86,7 +91,104 @@ request_group.add_argument(
           "Query the 'id' parameter"))
 request_group.add_argument(
     '--dbdump', action='store', metavar='PATH',
-    help=("The path to your database dump file"))
+    help=("The path to your database dump file, or its http(s)\n"
+          "URL to relay it to the upgrade platform without\n"
+          "storing it locally"))
+request_group.add_argument(
+    '--filestore', action='store', metavar='PATH',
+    help=("The filestore directory of your database. The SQL dump\n"
+          "and the filestore are uploaded as a zip, built on the fly"))
+request_group.add_argument(
+    '--pgdump', action='store', metavar='DBNAME',
+    help=("Instead of --dbdump: dump that database with pg_dump\n"
+          "(directory format) and upload it as a tar archive\n"
+          "while it is being dumped"))
+request_group.add_argument(
+    '--exclude-table-data', action='append', metavar='TABLE',
+    help=("Don't upload the rows of that table (a shell-style\n"
+          "pattern) from a plain SQL dump, for test upgrades.\n"
+          "Can be repeated"))
+request_group.add_argument(
+    '--batch', action='store', metavar='PATH',
+    help=("A file listing one 'PRIVATE_KEY ID' pair per line.\n"
+          "With the 'status' action, query all these requests\n"
+          "over a single connection"))
+
+pgdump_group = parser.add_argument_group("pg_dump arguments (--pgdump option)")
+pgdump_group.add_argument(
+    '--pgdump-jobs', default=1, type=int, action='store', metavar='N',
+    help="Number of tables dumped in parallel (default: %(default)s)")
+pgdump_group.add_argument(
+    '--pgdump-dir', action='store', metavar='PATH',
+    help=("Scratch directory for the dumped tables, removed as soon\n"
+          "as they are uploaded (default: the system temp directory)"))
+
+flight_group = parser.add_argument_group(
+    "Concurrency arguments ('upload' and 'all' actions)")
+flight_group.add_argument(
+    '--single-flight', default=False, action='store_true',
+    help=("If the same upload (same request and dump) or the same\n"
+          "'all' operation (same dump) is already running, wait for\n"
+          "it and display its result instead of running it again"))
+flight_group.add_argument(
+    '--lock-dir', default='~/.odoo_upgrade/locks', action='store',
+    metavar='PATH',
+    help=("Directory of the --single-flight lock and state files\n"
+          "(default: %(default)s)"))
+
+pipeline_group = parser.add_argument_group("Pipeline arguments ('all' action)")
+pipeline_group.add_argument(
+    '--pipeline', default=False, action='store_true',
+    help=("Start producing the dump (see --pgdump) while the request\n"
+          "is being created, and run all the operations on the same\n"
+          "connection"))
+
+logs_group = parser.add_argument_group("Log arguments ('logs' action)")
+logs_group.add_argument(
+    '-f', '--follow', default=False, action='store_true',
+    help="Keep on displaying the log as it grows, until interrupted")
+logs_group.add_argument(
+    '--offset', default=0, type=int, action='store', metavar='BYTES',
+    help=("Start displaying the log at that offset. The final offset\n"
+          "is reported in the output (default: %(default)s)"))
+logs_group.add_argument(
+    '--interval', default=5, type=float, action='store', metavar='SECONDS',
+    help="Polling interval with --follow (default: %(default)s)")
+
+network_group = parser.add_argument_group("Network arguments ('upload' action)")
+network_group.add_argument(
+    '--autotune', default=False, action='store_true',
+    help=("Measure the link to the upgrade platform during the first\n"
+          "seconds of the upload (Linux only), and size the socket\n"
+          "send buffer after it. The measures and the chosen settings\n"
+          "are reported in the 'tuning' key of the output"))
+network_group.add_argument(
+    '--buffer-size', type=int, action='store', metavar='BYTES',
+    help="Size of curl's upload buffer")
+network_group.add_argument(
+    '--sndbuf', type=int, action='store', metavar='BYTES',
+    help="Size of the socket send buffer")
+network_group.add_argument(
+    '--tcp-keepalive', type=int, action='store', metavar='SECONDS',
+    help="Send TCP keep-alive probes after that idle time")
+
+agent_group = parser.add_argument_group("Agent arguments ('serve' action)")
+agent_group.add_argument(
+    '--listen', default='127.0.0.1:8421', action='store',
+    metavar='[HOST:]PORT',
+    help="Address of the control endpoint (default: %(default)s)")
+agent_group.add_argument(
+    '--workers', default=4, type=int, action='store', metavar='N',
+    help="Number of jobs run concurrently (default: %(default)s)")
+agent_group.add_argument(
+    '--spool', default='~/.odoo_upgrade/jobs', action='store',
+    metavar='PATH',
+    help="Directory where the jobs are stored (default: %(default)s)")
+agent_group.add_argument(
+    '--token-file', action='store', metavar='PATH',
+    help=("File holding the token required by the control endpoint\n"
+          "(default: a random one, created in the --spool directory).\n"
+          "Mandatory to listen on another host than the loopback"))
 
 obscure_group = parser.add_argument_group(
     "Obscure arguments that you should not use")
@@ -101,6 +203,11 @@ obscure_group.add_argument(
     '--url', default=DEFAULT_URL,
     help="Upgrade platform URL (default: %(default)s)", action='store',
     metavar='URL')
+obscure_group.add_argument(
+    '--max-streams', default=16, type=int,
+    help=("Maximum number of concurrent queries with --batch\n"
+          "(default: %(default)s)"), action='store',
+    metavar='N')
 obscure_group.add_argument(
     '--debug', default=False,
     help="Debug", action='store_true',)
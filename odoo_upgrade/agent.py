@@ -0,0 +1,349 @@
+#!/usr/bin/env python
+#-*- encoding: utf8 -*-
+
+"""
+A long-running upgrade agent.
+
+Jobs (create, upload, process, status, all) are submitted to a local HTTP
+control endpoint, persisted in a spool directory and run by a pool of
+worker threads. Each worker keeps its own curl handle, hence warm
+connections to the upgrade platform, from one job to the next.
+
+Control endpoint:
+    POST /jobs        submit a job: {"action": "upload", "key": ..., ...}
+    GET  /jobs        list all the jobs
+    GET  /jobs/<id>   display a job
+
+Every request must hold an 'Authorization: Bearer <token>' header, with the
+token of the --token-file (created in the spool directory if not given).
+The private keys of the jobs are not displayed.
+"""
+
+import os
+import sys
+import copy
+import json
+import hmac
+import uuid
+import errno
+import binascii
+import logging
+import datetime
+import threading
+import Queue
+import BaseHTTPServer
+import SocketServer
+
+import pycurl
+
+from .odoo_upgrade import (
+    UpgradeManager, ERROR_INTERNAL, ERROR_MISSING_ARGUMENT)
+
+
+ACTIONS = ['create', 'upload', 'process', 'status', 'all']
+# actions which can safely be run again after an interruption. Running
+# 'create' (or 'all') again would create another upgrade request:
+IDEMPOTENT_ACTIONS = ['upload', 'process', 'status']
+# job parameters that may be set by a client, i.e. the request arguments:
+PARAMS = ['contract', 'email', 'target', 'aim', 'timezone', 'key',
+          'request', 'dbdump', 'filestore', 'pgdump', 'exclude_table_data',
+          'batch']
+
+# the control endpoint can only be exposed beyond the local host with an
+# explicit --token-file:
+LOOPBACK_HOSTS = ['', 'localhost', '127.0.0.1', '::1']
+REDACTED = '********'
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def now():
+    return datetime.datetime.utcnow().isoformat()
+
+
+def check_params(params):
+    """Check the types of the parameters of a job, and normalize them in
+    place. An error message, or None"""
+    unknown = set(params) - set(PARAMS)
+    if unknown:
+        return "Unknown parameters: {}".format(', '.join(sorted(unknown)))
+    if isinstance(params.get('exclude_table_data'), basestring):
+        params['exclude_table_data'] = [params['exclude_table_data']]
+    for param, value in params.items():
+        if value is None:
+            continue
+        if param == 'exclude_table_data':
+            valid = isinstance(value, list) and all(
+                isinstance(pattern, basestring) for pattern in value)
+        elif param == 'request':
+            valid = (isinstance(value, (basestring, int)) and
+                     not isinstance(value, bool))
+        else:
+            valid = isinstance(value, basestring)
+        if not valid:
+            return "Invalid value for '{}': {}".format(
+                param, json.dumps(value))
+
+
+def read_token(path):
+    """The token of the control endpoint, stored in ``path``. A random one is
+    generated if the file doesn't exist yet."""
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except OSError as exc:
+        if exc.errno != errno.EEXIST:
+            raise
+    else:
+        with os.fdopen(fd, 'w') as fp:
+            fp.write(binascii.hexlify(os.urandom(24)) + '\n')
+    if os.stat(path).st_mode & 0o077:
+        raise ValueError("The token file '{}' must only be readable by its "
+                         "owner (chmod 600)".format(path))
+    with open(path) as fp:
+        token = fp.read().strip()
+    if not token:
+        raise ValueError("The token file '{}' is empty".format(path))
+    return token
+
+
+def redact(job):
+    """A job, as displayed by the control endpoint: without its key"""
+    if job and job['params'].get('key'):
+        job['params']['key'] = REDACTED
+    return job
+
+
+class JobQueue(object):
+    """Persistent job queue: one JSON file per job in the spool directory."""
+
+    def __init__(self, spool):
+        self.spool = spool
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.queue = Queue.Queue()
+        try:
+            os.makedirs(spool, 0o700)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        self._load()
+
+    def _path(self, job_id):
+        return os.path.join(self.spool, job_id + '.json')
+
+    def _load(self):
+        jobs = []
+        for filename in os.listdir(self.spool):
+            if not filename.endswith('.json'):
+                continue
+            with open(os.path.join(self.spool, filename)) as fp:
+                jobs.append(json.load(fp))
+        for job in sorted(jobs, key=lambda job: job['created']):
+            self.jobs[job['id']] = job
+            if job['state'] == RUNNING and job['action'] not in IDEMPOTENT_ACTIONS:
+                job.update(
+                    state=FAILED,
+                    exitcode=ERROR_INTERNAL,
+                    error="Interrupted by a shutdown of the agent. Not run "
+                          "again, as it may already have created a request",
+                    finished=now())
+                self._save(job)
+            elif job['state'] in (QUEUED, RUNNING):
+                # interrupted by a previous shutdown, run it again:
+                job['state'] = QUEUED
+                self.queue.put(job['id'])
+
+    def _save(self, job):
+        path = self._path(job['id'])
+        with open(path + '.tmp', 'w') as fp:
+            json.dump(job, fp, indent=2, sort_keys=True)
+        os.rename(path + '.tmp', path)
+
+    def submit(self, action, params):
+        job = {
+            'id': uuid.uuid4().hex,
+            'action': action,
+            'params': params,
+            'state': QUEUED,
+            'exitcode': None,
+            'error': None,
+            'output': None,
+            'created': now(),
+            'started': None,
+            'finished': None,
+        }
+        with self.lock:
+            self.jobs[job['id']] = job
+            self._save(job)
+            job = copy.deepcopy(job)
+        self.queue.put(job['id'])
+        return job
+
+    def update(self, job_id, **values):
+        with self.lock:
+            job = self.jobs[job_id]
+            job.update(values)
+            self._save(job)
+            return copy.deepcopy(job)
+
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return copy.deepcopy(job) if job else None
+
+    def list(self):
+        with self.lock:
+            return sorted(copy.deepcopy(self.jobs.values()),
+                          key=lambda job: job['created'])
+
+
+class Worker(threading.Thread):
+    def __init__(self, agent):
+        super(Worker, self).__init__()
+        self.daemon = True
+        self.agent = agent
+
+    def run(self):
+        # kept for the whole life of the worker: connections stay warm
+        curl = pycurl.Curl()
+        try:
+            while True:
+                job_id = self.agent.jobs.queue.get()
+                self.agent.run_job(job_id, curl)
+        finally:
+            curl.close()
+
+
+class ControlHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def reply(self, code, obj):
+        body = json.dumps(obj, indent=2, sort_keys=True)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        scheme, _, token = (
+            self.headers.getheader('Authorization') or '').partition(' ')
+        return scheme.lower() == 'bearer' and hmac.compare_digest(
+            token.strip(), self.server.agent.token)
+
+    def do_GET(self):
+        if not self.authorized():
+            return self.reply(401, {'error': 'Unauthorized'})
+        jobs = self.server.agent.jobs
+        parts = filter(None, self.path.split('?')[0].split('/'))
+        if parts == ['jobs']:
+            return self.reply(200, [redact(job) for job in jobs.list()])
+        if len(parts) == 2 and parts[0] == 'jobs':
+            job = jobs.get(parts[1])
+            if job:
+                return self.reply(200, redact(job))
+        self.reply(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if not self.authorized():
+            return self.reply(401, {'error': 'Unauthorized'})
+        if self.path.split('?')[0].rstrip('/') != '/jobs':
+            return self.reply(404, {'error': 'Not found'})
+        length = int(self.headers.getheader('Content-Length') or 0)
+        try:
+            params = json.loads(self.rfile.read(length))
+            action = params.pop('action')
+        except (ValueError, KeyError, AttributeError):
+            return self.reply(400, {'error': "A JSON object with an 'action' key is expected"})
+        if action not in ACTIONS:
+            return self.reply(400, {'error': "Unknown action '{}'".format(action)})
+        error = check_params(params)
+        if error:
+            return self.reply(400, {'error': error})
+        job = self.server.agent.jobs.submit(action, params)
+        self.reply(201, redact(job))
+
+    def log_message(self, format, *args):
+        logging.debug("%s - %s", self.address_string(), format % args)
+
+
+class ControlServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Agent(object):
+    def __init__(self, args):
+        self.args = args
+        spool = os.path.expandvars(os.path.expanduser(args.spool))
+        self.jobs = JobQueue(spool)
+        self.token_file = os.path.expandvars(os.path.expanduser(
+            args.token_file or os.path.join(spool, 'token')))
+        self.token = read_token(self.token_file)
+
+    def job_args(self, job):
+        """The arguments of a job: the agent's ones overridden by the job
+        parameters"""
+        args = copy.copy(self.args)
+        for param in PARAMS:
+            setattr(args, param, None)
+        args.timezone = False
+        args.verbose = []
+        args.action = job['action']
+        for param, value in job['params'].items():
+            setattr(args, param, value)
+        return args
+
+    def run_job(self, job_id, curl):
+        job = self.jobs.update(job_id, state=RUNNING, started=now())
+        logging.info("Job {} ({}) started".format(job_id, job['action']))
+        manager = None
+        error = None
+        try:
+            manager = UpgradeManager(self.job_args(job), curl)
+            exitcode = manager.dispatch() or 0
+        except SystemExit as exc:
+            exitcode = exc.code or 0
+        except Exception as exc:
+            logging.exception("Job {} crashed".format(job_id))
+            exitcode = ERROR_INTERNAL
+            error = "{}: {}".format(type(exc).__name__, exc)
+        self.jobs.update(
+            job_id,
+            state=FAILED if exitcode else DONE,
+            exitcode=exitcode,
+            error=error,
+            output=manager.output if manager else None,
+            finished=now())
+        logging.info("Job {} finished with exitcode={}".format(
+            job_id, exitcode))
+
+    def control_server(self):
+        """The server of the control endpoint, or None if it can't be
+        started"""
+        host, _, port = self.args.listen.rpartition(':')
+        if host.strip('[]') not in LOOPBACK_HOSTS and not self.args.token_file:
+            logging.error("A --token-file is mandatory to listen on '{}', "
+                          "beyond the local host. Aborting".format(host))
+            return None
+        server = ControlServer((host or '127.0.0.1', int(port)), ControlHandler)
+        server.agent = self
+        return server
+
+    def serve(self):
+        server = self.control_server()
+        if server is None:
+            return ERROR_MISSING_ARGUMENT
+        for i in range(max(1, self.args.workers)):
+            Worker(self).start()
+        host, port = server.server_address[:2]
+        sys.stderr.write("Listening on http://{}:{}/jobs (token in {})\n"
+                         .format(host, port, self.token_file))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return 0
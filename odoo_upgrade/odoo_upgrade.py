@@ -16,10 +16,17 @@ from io import BytesIO
 import json
 import functools
 import datetime
+import time
 
 import pycurl
 import pytz
 
+from .sources import (
+    FileSource, PgDumpSource, TableFilterSource, UrlSource, ZipSource, is_url,
+    url_filename)
+from . import tuning
+from .singleflight import SingleFlight
+
 
 LOG_FMT = '%(message)s'
 PROGRESS_INTERVAL = 2
@@ -28,6 +35,9 @@ ERROR_HTTP_4xx = 1
 ERROR_HTTP_5xx = 2
 ERROR_MISSING_ARGUMENT = 3
 ERROR_FILE_NOT_FOUND = 4
+ERROR_TRANSFER = 5
+ERROR_DUMP = 6
+ERROR_INTERNAL = 7
 ERROR_MISSING_ARGUMENT_MSG = (
     "Argument '{}' is mandatory for '{}' action. Aborting")
 
@@ -44,13 +54,51 @@ TZ_GET = [
     if not tz.startswith('Etc/') else '_')]
 
 
+# HTTP/2 support depends on the pycurl/libcurl versions:
+PIPE_MULTIPLEX = getattr(pycurl, 'PIPE_MULTIPLEX', None)
+HTTP_VERSION_2 = getattr(pycurl, 'CURL_HTTP_VERSION_2TLS', None)
+HTTP_VERSION_INFO = getattr(pycurl, 'INFO_HTTP_VERSION', None)
+# the CURL_HTTP_VERSION_* values returned by INFO_HTTP_VERSION:
+HTTP_VERSIONS = {
+    pycurl.CURL_HTTP_VERSION_1_0: '1.0',
+    pycurl.CURL_HTTP_VERSION_1_1: '1.1',
+    getattr(pycurl, 'CURL_HTTP_VERSION_2_0', 3): '2',
+    getattr(pycurl, 'CURL_HTTP_VERSION_3', 30): '3',
+}
+
+
+def read_batch(path):
+    """Read (key, request) pairs from a batch file.
+
+    One 'KEY REQUEST_ID' pair per line. Blank lines and lines starting
+    with '#' are ignored.
+    """
+    pairs = []
+    with open(path) as fp:
+        for number, line in enumerate(fp, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            fields = line.split()
+            if len(fields) < 2:
+                logging.error(
+                    "{}, line {}: a 'PRIVATE_KEY ID' pair is expected. "
+                    "Aborting".format(path, number))
+                sys.exit(ERROR_MISSING_ARGUMENT)
+            pairs.append((fields[0], fields[1]))
+    return pairs
+
+
 def require(*requires):
     def decorator(method):
         @functools.wraps(method)
         def f(self, *args, **kwargs):
             for arg in requires:
-                if not getattr(self.args, arg):
-                    logging.error(ERROR_MISSING_ARGUMENT_MSG.format(arg, self.args.action))
+                # a tuple of arguments: any one of them is enough
+                alternatives = arg if isinstance(arg, tuple) else (arg,)
+                if not any(getattr(self.args, a) for a in alternatives):
+                    logging.error(ERROR_MISSING_ARGUMENT_MSG.format(
+                        "' or '".join(alternatives), self.args.action))
                     sys.exit(ERROR_MISSING_ARGUMENT)
             return method(self, *args, **kwargs)
         return f
@@ -58,29 +106,49 @@ def require(*requires):
 
 
 class CurlConnector(object):
-    def __init__(self, insecure=False, debug=False):
+    """Context manager yielding a configured curl handle.
+
+    If a long-lived ``handle`` is given, it is reset and reused instead of
+    creating a new one, so that its connection cache is kept warm; it is
+    left open on exit.
+    """
+    def __init__(self, insecure=False, debug=False, handle=None):
         self.insecure = insecure
         self.debug = debug
+        self.handle = handle
         self.curl = None
 
-    def __enter__(self):
-        self.curl = pycurl.Curl()
+    def new_curl(self, curl=None):
+        curl = curl or pycurl.Curl()
         if self.insecure:
-            self.curl.setopt(pycurl.SSL_VERIFYPEER, False)
-            self.curl.setopt(pycurl.SSL_VERIFYHOST, False)
+            curl.setopt(pycurl.SSL_VERIFYPEER, False)
+            curl.setopt(pycurl.SSL_VERIFYHOST, False)
 
         if self.debug:
-            self.curl.setopt(pycurl.VERBOSE, 1)
+            curl.setopt(pycurl.VERBOSE, 1)
 
+        return curl
+
+    def __enter__(self):
+        if self.handle is not None:
+            self.handle.reset()
+        self.curl = self.new_curl(self.handle)
         return self.curl
 
     def __exit__(self, type, value, tb):
-        self.curl.close()
+        if self.handle is None:
+            self.curl.close()
 
 
 class UpgradeManager(object):
-    def __init__(self, args):
+    def __init__(self, args, curl=None):
         self.args = args
+        # long-lived curl handle, reused by all the operations if set:
+        self.curl = curl
+        # in-flight operation shared with concurrent invocations, if any:
+        self.flight = None
+        # dump source opened ahead of the upload, if any:
+        self.source = None
         self.verbose = len(self.args.verbose)
         self._set_logging()
         self.output = self.init_output()
@@ -101,6 +169,15 @@ class UpgradeManager(object):
             sys.exit(3)
 
     def run(self):
+        status = self.dispatch()
+        sys.exit(status if status else 0)
+
+    def dispatch(self):
+        if self.args.single_flight and self.args.action in ('upload', 'all'):
+            return self.single_flight()
+        return self._dispatch()
+
+    def _dispatch(self):
         status = None
         if self.args.action == 'create':
             status = self.create()
@@ -111,16 +188,21 @@ class UpgradeManager(object):
         elif self.args.action == 'all':
             status = self.do_all()
         elif self.args.action == 'status':
-            status = self.status()
-
-        sys.exit(status if status else 0)
-
-    @require('contract', 'email', 'target', 'aim', 'dbdump')
+            if self.args.batch:
+                status = self.status_batch()
+            else:
+                status = self.status()
+        elif self.args.action == 'logs':
+            status = self.logs()
+        elif self.args.action == 'serve':
+            status = self.serve()
+        return status
+
+    @require('contract', 'email', 'target', 'aim', ('dbdump', 'pgdump'))
     def create(self):
         API_PATH = "/database/v1/create"
         self.output['operation'] = 'create'
-        dbdump = os.path.expandvars(os.path.expanduser(self.args.dbdump))
-        filename = os.path.split(dbdump)[1]
+        filename = self.dump_filename()
         fields = dict(filter(None, [
             ('contract', self.args.contract),
             ('email', self.args.email),
@@ -131,7 +213,7 @@ class UpgradeManager(object):
         ]))
         postfields = urlencode(fields)
 
-        with CurlConnector(self.args.insecure, self.args.debug) as curl:
+        with self.connector() as curl:
             headers = {}
             curl.setopt(
                 pycurl.HTTPHEADER,
@@ -161,7 +243,7 @@ class UpgradeManager(object):
             if http_status >= 400:
                 return ERROR_HTTP_4xx if http_status < 500 else ERROR_HTTP_5xx
 
-    @require('key', 'request', 'dbdump')
+    @require('key', 'request', ('dbdump', 'pgdump'))
     def upload(self):
         API_PATH = "/database/v1/upload"
         self.output['operation'] = 'upload'
@@ -171,24 +253,30 @@ class UpgradeManager(object):
         ])
         postfields = urlencode(fields)
 
-        # check the exitence of the dump file:
-        dbdump = os.path.expandvars(os.path.expanduser(self.args.dbdump))
+        # already opened by a pipelined 'all':
+        source = self.source or self.open_dump()
+        self.source = None
+        if isinstance(source, int):
+            return source
 
-        if not os.path.isfile(dbdump):
-            sys.stderr.write("Dump file '{}' not found\n".format(dbdump))
-            return ERROR_FILE_NOT_FOUND
-
-        with CurlConnector(self.args.insecure, self.args.debug) as curl:
+        with self.connector() as curl:
+            tuner = self.tune_upload(curl)
             curl.setopt(pycurl.URL, self.args.url+API_PATH+'?'+postfields)
             curl.setopt(pycurl.POST, 1)
             data = BytesIO()
             curl.setopt(curl.WRITEFUNCTION, data.write)
 
-            filesize = os.path.getsize(dbdump)
-            curl.setopt(pycurl.POSTFIELDSIZE, filesize)
-            fp = open(dbdump, 'rb')
-            curl.setopt(pycurl.READFUNCTION, fp.read)
             headers = {"Content-Type": "application/octet-stream"}
+            if source.size is not None:
+                curl.setopt(pycurl.POSTFIELDSIZE, source.size)
+            else:
+                # the dump is produced while being uploaded:
+                headers["Transfer-Encoding"] = "chunked"
+            curl.setopt(pycurl.READFUNCTION, source.read)
+            if hasattr(source, 'seek'):
+                # lets curl send the dump again on a new connection if a
+                # reused one turns out to be closed
+                curl.setopt(pycurl.SEEKFUNCTION, source.seek)
             curl.setopt(
                 pycurl.HTTPHEADER,
                 ['%s: %s' % (k, headers[k]) for k in headers])
@@ -196,8 +284,10 @@ class UpgradeManager(object):
             self.t1 = datetime.datetime.now()
             self.t0 = self.t1
 
-            if self.verbose > 0:
+            if self.verbose > 0 or self.flight or tuner:
                 def progress(to_download, downloaded, to_upload, uploaded):
+                    if tuner:
+                        tuner.progress(uploaded)
                     def display_delta(delta):
                         hours, remainder = divmod(delta.total_seconds(), 3600)
                         minutes, seconds = divmod(remainder, 60)
@@ -206,25 +296,54 @@ class UpgradeManager(object):
 
                     self.t2 = datetime.datetime.now()
                     if uploaded and (self.t2 - self.t1).total_seconds() > PROGRESS_INTERVAL:
-                        eta = datetime.timedelta(
-                            seconds=((self.t2 - self.t0).total_seconds()
-                                * to_upload / uploaded))
-                        s = ("{}/{} bytes uploaded ({:.2%}) in {} "
-                             "(TOTAL estimated time: {})").format(
-                                int(uploaded), int(to_upload),
-                                (uploaded / to_upload),
-                                display_delta(self.t2 - self.t0),
-                                display_delta(eta))
-                        sys.stderr.write(s+'\r')
-                        sys.stderr.flush()
+                        if not to_upload:
+                            # unknown size: the dump is still being produced
+                            s = "{} bytes uploaded in {}".format(
+                                int(uploaded), display_delta(self.t2 - self.t0))
+                        else:
+                            eta = datetime.timedelta(
+                                seconds=((self.t2 - self.t0).total_seconds()
+                                    * to_upload / uploaded))
+                            s = ("{}/{} bytes uploaded ({:.2%}) in {} "
+                                 "(TOTAL estimated time: {})").format(
+                                    int(uploaded), int(to_upload),
+                                    (uploaded / to_upload),
+                                    display_delta(self.t2 - self.t0),
+                                    display_delta(eta))
+                        if self.flight:
+                            # shared with the invocations attached to this one
+                            self.flight.progress(s)
+                        if self.verbose > 0:
+                            sys.stderr.write(s+'\r')
+                            sys.stderr.flush()
                         self.t1 = datetime.datetime.now()
 
                 curl.setopt(curl.NOPROGRESS, 0)
                 curl.setopt(curl.PROGRESSFUNCTION, progress)
 
-            curl.perform()
+            try:
+                if isinstance(source, UrlSource):
+                    source.relay(curl)
+                else:
+                    curl.perform()
+            except pycurl.error:
+                if not source.error:
+                    raise
+                logging.error(source.error)
+                return ERROR_DUMP
+            finally:
+                source.close()
             http_status = curl.getinfo(pycurl.HTTP_CODE)
 
+            if isinstance(source, ZipSource):
+                self.output['filestore'] = dict(
+                    files=len(source.entries) - 1,
+                    stored=source.stored)
+                source = source.dump
+            if isinstance(source, TableFilterSource):
+                # bytes dropped per table:
+                self.output['excluded_table_data'] = source.dropped
+
             self.output['http_status'] = dict(
                 code=http_status,
                 reason=httplib.responses[http_status])
@@ -254,7 +373,7 @@ class UpgradeManager(object):
         ])
         postfields = urlencode(fields)
 
-        with CurlConnector(self.args.insecure, self.args.debug) as curl:
+        with self.connector() as curl:
             headers = {}
             curl.setopt(
                 pycurl.HTTPHEADER,
@@ -294,7 +413,7 @@ class UpgradeManager(object):
         ])
         postfields = urlencode(fields)
 
-        with CurlConnector(self.args.insecure, self.args.debug) as curl:
+        with self.connector() as curl:
             headers = {}
             curl.setopt(
                 pycurl.HTTPHEADER,
@@ -323,8 +442,251 @@ class UpgradeManager(object):
             if http_status >= 400:
                 return ERROR_HTTP_4xx if http_status < 500 else ERROR_HTTP_5xx
 
-    @require('contract', 'email', 'target', 'aim', 'dbdump')
+    @require('batch')
+    def status_batch(self):
+        """Query the status of many requests over a single connection.
+
+        The (key, request) pairs are read from the ``--batch`` file. Over
+        HTTP/2 the queries are multiplexed as concurrent streams of one
+        connection; over HTTP/1.1 they fall back to a pool of keep-alive
+        connections. At most ``--max-streams`` queries are in flight.
+        """
+        API_PATH = "/database/v1/status"
+        self.output['operation'] = 'status'
+
+        batch = os.path.expandvars(os.path.expanduser(self.args.batch))
+        if not os.path.isfile(batch):
+            sys.stderr.write("Batch file '{}' not found\n".format(batch))
+            return ERROR_FILE_NOT_FOUND
+        pending = read_batch(batch)
+        max_streams = max(1, self.args.max_streams)
+
+        connector = CurlConnector(self.args.insecure, self.args.debug)
+        multi = pycurl.CurlMulti()
+        if PIPE_MULTIPLEX is not None:
+            multi.setopt(pycurl.M_PIPELINING, PIPE_MULTIPLEX)
+        if hasattr(pycurl, 'M_MAX_HOST_CONNECTIONS'):
+            multi.setopt(pycurl.M_MAX_HOST_CONNECTIONS, max_streams)
+
+        free = []
+        for i in range(min(max_streams, len(pending))):
+            curl = connector.new_curl()
+            curl.setopt(pycurl.URL, self.args.url+API_PATH)
+            if HTTP_VERSION_2 is not None:
+                curl.setopt(pycurl.HTTP_VERSION, HTTP_VERSION_2)
+            if hasattr(pycurl, 'PIPEWAIT'):
+                # wait for a multiplexable connection rather than opening
+                # a new one:
+                curl.setopt(pycurl.PIPEWAIT, 1)
+            free.append(curl)
+        handles = list(free)
+
+        # one row per request, in the order of the batch file:
+        rows = [None] * len(pending)
+        active = 0
+        exitcode = 0
+
+        def done(curl, error=None):
+            http_status = curl.getinfo(pycurl.HTTP_CODE)
+            row = {
+                'request': curl.request,
+                'http_status': dict(
+                    code=http_status,
+                    reason=httplib.responses.get(http_status, '')),
+                'http_version': HTTP_VERSIONS.get(
+                    curl.getinfo(HTTP_VERSION_INFO))
+                if HTTP_VERSION_INFO is not None else None,
+                'state': None,
+                'upgrade_response': None,
+            }
+            if error:
+                row['error'] = error
+                code = ERROR_TRANSFER
+            else:
+                try:
+                    upgrade_response = json.loads(curl.data.getvalue())
+                except ValueError:
+                    upgrade_response = curl.data.getvalue()
+                row['upgrade_response'] = upgrade_response
+                if isinstance(upgrade_response, dict):
+                    row['state'] = (upgrade_response.get('request') or {}).get('state')
+                code = 0
+                if http_status >= 400:
+                    code = ERROR_HTTP_4xx if http_status < 500 else ERROR_HTTP_5xx
+            rows[curl.index] = row
+            multi.remove_handle(curl)
+            free.append(curl)
+            return code
+
+        try:
+            while pending or active:
+                while pending and free:
+                    key, request = pending.pop(0)
+                    curl = free.pop()
+                    curl.index = len(rows) - len(pending) - 1
+                    curl.request = request
+                    curl.data = BytesIO()
+                    curl.setopt(curl.POSTFIELDS, urlencode(
+                        [('key', key), ('request', request)]))
+                    curl.setopt(curl.WRITEFUNCTION, curl.data.write)
+                    multi.add_handle(curl)
+                    active += 1
+
+                while True:
+                    ret, num_handles = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+
+                while True:
+                    num_q, ok_list, err_list = multi.info_read()
+                    for curl in ok_list:
+                        exitcode = max(exitcode, done(curl))
+                        active -= 1
+                    for curl, errno, errmsg in err_list:
+                        exitcode = max(exitcode, done(curl, errmsg))
+                        active -= 1
+                    if num_q == 0:
+                        break
+
+                if active:
+                    multi.select(1.0)
+        finally:
+            for curl in handles:
+                curl.close()
+            multi.close()
+
+        self.output['upgrade_response'] = rows
+
+        # output display:
+        logging.info(self.format_json(self.output))
+
+        return exitcode
+
+    @require('key', 'request')
+    def logs(self):
+        """Write the log of the request on stdout.
+
+        Only the bytes past the current offset are fetched (HTTP Range
+        requests), and they are written as they arrive. With --follow, the
+        log is polled every --interval seconds on the same connection until
+        interrupted.
+        """
+        API_PATH = "/database/v1/logs"
+        self.output['operation'] = 'logs'
+        fields = dict([
+            ('key', self.args.key),
+            ('request', self.args.request),
+        ])
+        postfields = urlencode(fields)
+        self.offset = self.args.offset or 0
+
+        with self.connector() as curl:
+            curl.setopt(pycurl.URL, self.args.url+API_PATH+'?'+postfields)
+
+            # getinfo() can't be called during perform(): the status of the
+            # response is taken from its status line
+            def header(line):
+                if line.startswith(b'HTTP/'):
+                    # also reset by the final response after a 1xx one
+                    self.log_status = int(line.split()[1])
+            curl.setopt(pycurl.HEADERFUNCTION, header)
+
+            def write(chunk):
+                if self.log_status == 200 and self.skip:
+                    # the server ignored the range: drop what we already have
+                    skipped = min(self.skip, len(chunk))
+                    self.skip -= skipped
+                    chunk = chunk[skipped:]
+                if self.log_status in (200, 206):
+                    sys.stdout.write(chunk)
+                    sys.stdout.flush()
+                    self.offset += len(chunk)
+                else:
+                    self.log_error.write(chunk)
+            curl.setopt(curl.WRITEFUNCTION, write)
+
+            http_status = None
+            error = None
+            try:
+                while True:
+                    self.skip = self.offset
+                    self.log_status = None
+                    self.log_error = BytesIO()
+                    curl.setopt(pycurl.HTTPHEADER, [
+                        'Range: bytes={}-'.format(self.offset)])
+                    curl.perform()
+                    http_status = curl.getinfo(pycurl.HTTP_CODE)
+                    # 416: nothing new past the offset
+                    if http_status >= 400 and http_status != 416:
+                        break
+                    if not self.args.follow:
+                        break
+                    time.sleep(self.args.interval)
+            except KeyboardInterrupt:
+                pass
+            except pycurl.error as exc:
+                error = exc.args[-1]
+
+            # the offset to resume from is output in any case
+            if http_status:
+                self.output['http_status'] = dict(
+                    code=http_status,
+                    reason=httplib.responses.get(http_status, ''))
+            if error:
+                self.output['error'] = error
+            self.output['offset'] = self.offset
+
+            if self.verbose > 1:
+                self.output['curl_info'].update({
+                    info: curl.getinfo(getattr(pycurl, info))
+                    for info
+                    in CURLINFO})
+
+            if http_status >= 400 and http_status != 416:
+                try:
+                    self.output['upgrade_response'] = json.loads(
+                        self.log_error.getvalue())
+                except ValueError:
+                    self.output['upgrade_response'] = self.log_error.getvalue()
+
+            # output display:
+            logging.info(self.format_json(self.output))
+
+            if error:
+                return ERROR_TRANSFER
+            if http_status >= 400 and http_status != 416:
+                return ERROR_HTTP_4xx if http_status < 500 else ERROR_HTTP_5xx
+
+    @require('contract', 'email', 'target', 'aim', ('dbdump', 'pgdump'))
     def do_all(self):
+        if self.args.exclude_table_data and self.args.aim == 'production':
+            logging.error("Table data can only be excluded for test upgrades "
+                          "(--aim test). Aborting")
+            sys.exit(ERROR_MISSING_ARGUMENT)
+        if not self.args.pipeline:
+            return self._do_all()
+
+        # pipelined: start producing the dump right away, and run all the
+        # operations on one handle, so that the upload reuses the connection
+        # opened by 'create' while the dump was being produced
+        self.source = self.open_dump()
+        if isinstance(self.source, int):
+            exitcode, self.source = self.source, None
+            return exitcode
+        owned = self.curl is None
+        if owned:
+            self.curl = pycurl.Curl()
+        try:
+            return self._do_all()
+        finally:
+            # left unused if 'create' failed:
+            if self.source:
+                self.source.close()
+            if owned:
+                self.curl.close()
+                self.curl = None
+
+    def _do_all(self):
         exitcode = self.create()
         if exitcode:
             logging.error("'create' exited with status code={}".format(exitcode))
@@ -345,6 +707,179 @@ class UpgradeManager(object):
             logging.error("'status' exited with status code={}".format(exitcode))
             sys.exit(exitcode)
 
+    def tune_upload(self, curl):
+        """Apply the network settings of the upload to a curl handle.
+        Return the AutoTuner to feed with the progress of the upload, with
+        --autotune.
+
+        With --autotune, no test transfer is made: the link is measured
+        during the first seconds of the upload, on its own connection, and
+        the socket send buffer is then sized after it. Explicit
+        --buffer-size, --sndbuf, --tcp-keepalive values win.
+        """
+        settings = {}
+        tuner = None
+        if self.args.autotune:
+            settings = tuning.tune(None, None)
+        for option in ('buffer_size', 'sndbuf', 'tcp_keepalive'):
+            if getattr(self.args, option):
+                settings[option] = getattr(self.args, option)
+        if settings:
+            tuning.apply_settings(curl, settings)
+            self.output['tuning'] = settings
+        if self.args.autotune:
+            tuner = tuning.AutoTuner(settings)
+            # a connection of our own, to know its socket:
+            curl.setopt(pycurl.FRESH_CONNECT, 1)
+            curl.setopt(pycurl.SOCKOPTFUNCTION, tuner.sockopt)
+        return tuner
+
+    def flight_key(self):
+        """Identify an upload or all operation: the same dump, with the
+        same filestore and excluded table data (and the same request for an
+        upload)"""
+        if self.args.pgdump:
+            dump = 'pgdump:{}:{}:{}'.format(
+                os.environ.get('PGHOST', ''), os.environ.get('PGPORT', ''),
+                self.args.pgdump)
+        elif is_url(self.args.dbdump):
+            # without the query string, which holds volatile signatures
+            dump = self.args.dbdump.split('?', 1)[0]
+        else:
+            dbdump = os.path.realpath(
+                os.path.expandvars(os.path.expanduser(self.args.dbdump)))
+            dump = dbdump
+            if os.path.isfile(dbdump):
+                stat = os.stat(dbdump)
+                dump += ':{}:{}'.format(stat.st_size, stat.st_mtime)
+        if self.args.filestore:
+            dump += ':filestore={}'.format(os.path.realpath(
+                os.path.expandvars(os.path.expanduser(self.args.filestore))))
+        if self.args.exclude_table_data:
+            # the same dump without some table data is another upload
+            dump += ':exclude={}'.format(
+                ','.join(sorted(set(self.args.exclude_table_data))))
+        if self.args.action == 'upload':
+            return 'upload:{}:{}:{}'.format(
+                self.args.url, self.args.request, dump)
+        return 'all:{}:{}:{}:{}:{}'.format(
+            self.args.url, self.args.contract, self.args.target,
+            self.args.aim, dump)
+
+    def single_flight(self):
+        """Run the operation, unless the same one is already running in
+        another invocation: then wait for it and take its result."""
+        lock_dir = os.path.expandvars(os.path.expanduser(self.args.lock_dir))
+        flight = SingleFlight(lock_dir, self.flight_key())
+
+        def operation():
+            self.flight = flight
+            try:
+                exitcode = self._dispatch()
+            except SystemExit as exc:
+                exitcode = exc.code
+            finally:
+                self.flight = None
+            return exitcode or 0, self.output
+
+        def progress(state):
+            sys.stderr.write("[pid {}] {}\r".format(
+                state['pid'], state['progress']))
+            sys.stderr.flush()
+
+        state, attached = flight.run(
+            operation, progress if self.verbose > 0 else None)
+        if attached:
+            self.output = state['output']
+            self.output['single_flight'] = {
+                'attached': True,
+                'pid': state['pid'],
+                'started': state['started'],
+            }
+            # output display:
+            logging.info(self.format_json(self.output))
+        return state['exitcode']
+
+    def dump_filename(self):
+        if self.args.pgdump:
+            # not a 'pg_dump --format=tar' archive: a tar of a directory dump
+            return self.args.pgdump + '.dir.tar'
+        if is_url(self.args.dbdump):
+            return url_filename(self.args.dbdump)
+        dbdump = os.path.expandvars(os.path.expanduser(self.args.dbdump))
+        if self.args.filestore:
+            # db.sql.gz -> db.zip
+            name = os.path.split(dbdump)[1]
+            for suffix in ('.gz', '.sql'):
+                if name.endswith(suffix):
+                    name = name[:-len(suffix)]
+            return name + '.zip'
+        return os.path.split(dbdump)[1]
+
+    def open_dump(self):
+        """The source of the upload: the dump file, a dump relayed from an
+        http(s) URL, or a database dumped on the fly with --pgdump. An exit
+        code if it can't be opened.
+
+        The data of the --exclude-table-data tables is dropped on the fly
+        from plain SQL dump files, or left out by pg_dump. With --filestore,
+        the SQL dump file and the filestore are zipped on the fly.
+        """
+        if self.args.filestore and (self.args.pgdump or is_url(self.args.dbdump)):
+            sys.stderr.write("--filestore can only be used with a SQL dump "
+                             "file\n")
+            return ERROR_FILE_NOT_FOUND
+
+        if self.args.pgdump:
+            try:
+                return PgDumpSource(
+                    self.args.pgdump, self.args.pgdump_jobs,
+                    self.args.pgdump_dir, self.args.exclude_table_data or ())
+            except OSError as exc:
+                logging.error("Could not run pg_dump: {}".format(exc))
+                return ERROR_DUMP
+
+        if is_url(self.args.dbdump):
+            if self.args.exclude_table_data:
+                sys.stderr.write("--exclude-table-data can't be used with a "
+                                 "dump URL\n")
+                return ERROR_FILE_NOT_FOUND
+            return UrlSource(self.args.dbdump, self.connector().new_curl())
+
+        # check the exitence of the dump file:
+        dbdump = os.path.expandvars(os.path.expanduser(self.args.dbdump))
+
+        if not os.path.isfile(dbdump):
+            sys.stderr.write("Dump file '{}' not found\n".format(dbdump))
+            return ERROR_FILE_NOT_FOUND
+        source = FileSource(dbdump)
+        if self.args.exclude_table_data:
+            # the zip takes plain SQL: don't gzip the filtered dump again
+            source = TableFilterSource(
+                source, self.args.exclude_table_data,
+                compress=not self.args.filestore)
+        if self.args.filestore:
+            filestore = os.path.expandvars(
+                os.path.expanduser(self.args.filestore))
+            if not os.path.isdir(filestore):
+                sys.stderr.write("Filestore '{}' not found\n".format(filestore))
+                return ERROR_FILE_NOT_FOUND
+            source = ZipSource(source, filestore)
+        return source
+
+    def serve(self):
+        from .agent import Agent
+        try:
+            agent = Agent(self.args)
+        except ValueError as exc:
+            # unusable token file
+            logging.error("{}. Aborting".format(exc))
+            return ERROR_MISSING_ARGUMENT
+        return agent.serve()
+
+    def connector(self):
+        return CurlConnector(self.args.insecure, self.args.debug, self.curl)
+
     def init_output(self):
         return {
             'operation': '',
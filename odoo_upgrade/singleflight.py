@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+#-*- encoding: utf8 -*-
+
+"""
+Single-flight execution of the operations.
+
+An operation is identified by a key. The first invocation running it holds
+an exclusive lock on a file derived from the key and publishes its progress
+and its result in a state file next to it. Any other invocation of the same
+operation waits for the lock to be released and takes that result, instead
+of running the operation a second time.
+"""
+
+import os
+import time
+import json
+import uuid
+import errno
+import fcntl
+import hashlib
+import datetime
+
+
+# how often a waiting invocation checks the running one:
+POLL_INTERVAL = 2
+
+
+class SingleFlight(object):
+    def __init__(self, lock_dir, key):
+        try:
+            os.makedirs(lock_dir, 0o700)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+        name = hashlib.sha1(key).hexdigest()
+        self.key = key
+        self.lock_path = os.path.join(lock_dir, name + '.lock')
+        self.state_path = os.path.join(lock_dir, name + '.json')
+        self.state = None
+
+    def read_state(self):
+        try:
+            with open(self.state_path) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return None
+
+    def write_state(self, **values):
+        self.state.update(values)
+        with open(self.state_path + '.tmp', 'w') as fp:
+            json.dump(self.state, fp, indent=2, sort_keys=True)
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+    def progress(self, message):
+        """Publish the progress of the running operation"""
+        self.write_state(progress=message)
+
+    def run(self, operation, on_progress=None):
+        """Run ``operation`` (a function returning an (exitcode, output)
+        tuple), or wait for the invocation already running it.
+
+        Return the final state of the operation, and whether it was run by
+        another invocation. ``on_progress`` is called with the state of the
+        running invocation while waiting.
+        """
+        with open(self.lock_path, 'a') as fp:
+            while True:
+                try:
+                    fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError as exc:
+                    if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    state = self.wait(fp, on_progress)
+                    if state:
+                        return state, True
+                    # the running invocation died: take over
+                    continue
+                try:
+                    return self.lead(operation), False
+                finally:
+                    fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def lead(self, operation):
+        self.state = {}
+        self.write_state(
+            key=self.key,
+            token=uuid.uuid4().hex,
+            pid=os.getpid(),
+            started=datetime.datetime.utcnow().isoformat(),
+            progress=None,
+            finished=None,
+            exitcode=None,
+            output=None)
+        exitcode, output = operation()
+        self.write_state(
+            finished=datetime.datetime.utcnow().isoformat(),
+            exitcode=exitcode,
+            output=output)
+        return self.state
+
+    def wait(self, fp, on_progress):
+        """Wait for the running invocation to release the lock. Return its
+        final state, or None if it didn't finish."""
+        state = self.read_state()
+        # the result of a previous run of the operation, if any:
+        stale = state['token'] if state and state['finished'] else None
+        while True:
+            if on_progress and state and not state['finished'] and state['progress']:
+                on_progress(state)
+            try:
+                fcntl.flock(fp, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except IOError as exc:
+                if exc.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                time.sleep(POLL_INTERVAL)
+                state = self.read_state()
+                continue
+            fcntl.flock(fp, fcntl.LOCK_UN)
+            state = self.read_state()
+            if state and state['finished'] and state['token'] != stale:
+                return state
+            return None
@@ -0,0 +1,647 @@
+#!/usr/bin/env python
+#-*- encoding: utf8 -*-
+
+"""
+Dump sources for the upload.
+
+A source is a file-like object read by curl's READFUNCTION. Its ``size`` is
+None when it isn't known in advance, in which case the upload is sent with
+a chunked transfer encoding. Its ``error`` is set if the dump could not be
+produced.
+"""
+
+import os
+import time
+import zlib
+import struct
+import zipfile
+import itertools
+import fnmatch
+import shutil
+import tarfile
+import tempfile
+import threading
+import subprocess
+import collections
+from urllib import unquote
+from urlparse import urlparse
+
+import pycurl
+
+
+# how often the pg_dump output directory is scanned for finished files:
+POLL_INTERVAL = 0.5
+# size of the chunks read from the dump and sent to curl by the filters:
+CHUNK_SIZE = 64 * 1024
+GZIP_MAGIC = b'\x1f\x8b'
+# zlib window bits for the gzip format:
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+# maximum amount of data held in memory while relaying a remote dump:
+RELAY_BUFFER_SIZE = 8 * 1024 * 1024
+# a file is stored in a zip rather than deflated if deflating its head
+# doesn't save more than that ratio:
+MIN_DEFLATE_RATIO = 0.9
+# magic numbers of already compressed formats: (offset, magic)
+COMPRESSED_MAGICS = [
+    (0, b'\xff\xd8\xff'),          # jpeg
+    (0, b'\x89PNG'),                # png
+    (0, b'GIF8'),                   # gif
+    (0, b'PK\x03\x04'),             # zip, office documents
+    (0, b'\x1f\x8b'),               # gzip
+    (0, b'BZh'),                    # bzip2
+    (0, b'\xfd7zXZ'),               # xz
+    (0, b'7z\xbc\xaf'),             # 7-zip
+    (0, b'Rar!'),                   # rar
+    (4, b'ftyp'),                   # mp4, mov, heic
+    (8, b'WEBP'),                   # webp
+]
+# files written by pg_dump once all the data has been dumped:
+PGDUMP_TOC_FILES = ('toc.dat', 'blobs.toc')
+
+
+class FileSource(object):
+    def __init__(self, path):
+        self.size = os.path.getsize(path)
+        self.fp = open(path, 'rb')
+        self.error = None
+
+    def read(self, size):
+        return self.fp.read(size)
+
+    def seek(self, offset, origin):
+        self.fp.seek(offset, origin)
+        return pycurl.SEEKFUNC_OK
+
+    def close(self):
+        self.fp.close()
+
+
+def is_url(path):
+    return urlparse(path).scheme in ('http', 'https')
+
+
+def url_filename(url):
+    """The file name of a dump URL: the last part of its path"""
+    return unquote(urlparse(url).path.rstrip('/').rsplit('/', 1)[-1])
+
+
+def process_tree(pid):
+    """The pids of a process and of all its descendants, or None if they
+    can't be found (no /proc filesystem)"""
+    if not os.path.isdir('/proc/self/fd'):
+        return None
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(entry)) as fp:
+                # the command name, in brackets, may contain spaces:
+                stat = fp.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        parents[int(entry)] = int(stat[1])
+    pids = set([pid])
+    added = True
+    while added:
+        children = set(p for p, ppid in parents.items() if ppid in pids)
+        added = bool(children - pids)
+        pids |= children
+    return pids
+
+
+def open_files(pids):
+    """The files currently opened by a set of processes"""
+    files = set()
+    for pid in pids:
+        fd_dir = '/proc/{}/fd'.format(pid)
+        try:
+            fds = os.listdir(fd_dir)
+        except OSError:
+            continue
+        for fd in fds:
+            try:
+                files.add(os.readlink(os.path.join(fd_dir, fd)))
+            except OSError:
+                continue
+    return files
+
+
+class PgDumpSource(object):
+    """Dump a database with ``pg_dump -Fd -j JOBS`` and stream it as a tar
+    archive.
+
+    The archive holds the dump directory (``DBNAME/``, with its toc.dat and
+    data files): it isn't a ``pg_dump -Ft`` archive, it has to be extracted
+    before being restored with pg_restore.
+
+    The table files are packed (and removed from the scratch directory) as
+    soon as pg_dump has finished writing them, so that the dump and the
+    upload overlap. The connection to the database is set up with the usual
+    libpq environment variables (PGHOST, PGPORT, PGUSER, ...).
+    """
+    size = None
+
+    def __init__(self, dbname, jobs=1, tmpdir=None, exclude_table_data=()):
+        self.error = None
+        self.workdir = tempfile.mkdtemp(prefix='odoo_upgrade-', dir=tmpdir)
+        # pg_dump wants to create the output directory itself:
+        self.path = os.path.join(self.workdir, dbname)
+        try:
+            self.process = subprocess.Popen([
+                'pg_dump', '--format=directory', '--jobs', str(jobs),
+                '--file', self.path] + [
+                '--exclude-table-data=' + pattern
+                for pattern in exclude_table_data] + [dbname])
+        except OSError:
+            # pg_dump not found, or not executable
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            raise
+        rfd, wfd = os.pipe()
+        self.fp = os.fdopen(rfd, 'rb')
+        self.thread = threading.Thread(
+            target=self._pack, args=(os.fdopen(wfd, 'wb'),))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _finished_files(self, running):
+        if not os.path.isdir(self.path):
+            return []
+        names = sorted(os.listdir(self.path))
+        if not running:
+            return names
+        pids = process_tree(self.process.pid)
+        if pids is None:
+            # no way to know which files are still being written:
+            return []
+        opened = open_files(pids)
+        return [
+            name for name in names
+            if name not in PGDUMP_TOC_FILES
+            and os.path.join(self.path, name) not in opened]
+
+    def _pack(self, fp):
+        tar = tarfile.open(fileobj=fp, mode='w|')
+        arcname = os.path.basename(self.path)
+        try:
+            info = tarfile.TarInfo(arcname)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o700
+            info.mtime = time.time()
+            tar.addfile(info)
+            while True:
+                running = self.process.poll() is None
+                for name in self._finished_files(running):
+                    path = os.path.join(self.path, name)
+                    tar.add(path, arcname=os.path.join(arcname, name))
+                    os.unlink(path)
+                if not running:
+                    break
+                time.sleep(POLL_INTERVAL)
+            if self.process.returncode:
+                self.error = "pg_dump exited with status code={}".format(
+                    self.process.returncode)
+            else:
+                tar.close()
+        except (IOError, OSError) as exc:
+            self.error = "Could not pack the dump: {}".format(exc)
+        finally:
+            if self.error:
+                # drop the truncated archive without writing its end:
+                tar.fileobj.closed = True
+            try:
+                fp.close()
+            except IOError:
+                # the upload was interrupted
+                pass
+
+    def read(self, size):
+        data = self.fp.read(size)
+        if not data:
+            self.thread.join()
+            if self.error:
+                return pycurl.READFUNC_ABORT
+        return data
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.fp.close()
+        self.thread.join()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+class ChunkedSource(object):
+    """Base class of the sources produced by a generator of chunks"""
+    size = None
+
+    def __init__(self):
+        self.error = None
+        self.buffer = b''
+        self.chunks = self.generate()
+
+    def generate(self):
+        raise NotImplementedError
+
+    def read(self, size):
+        pieces = [self.buffer]
+        length = len(self.buffer)
+        while length < size:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                break
+            except (zlib.error, IOError, OSError) as exc:
+                # an exception would escape from curl's READFUNCTION, and
+                # the upload be taken for interrupted
+                self.error = "Could not read the dump: {}".format(exc)
+                break
+            pieces.append(chunk)
+            length += len(chunk)
+        if self.error:
+            return pycurl.READFUNC_ABORT
+        data = b''.join(pieces)
+        self.buffer = data[size:]
+        return data[:size]
+
+
+class SqlSource(ChunkedSource):
+    """A plain SQL dump, decompressed on the fly if gzipped (concatenated
+    gzip members included). Custom-format and zipped dumps are refused.
+    ``gzip`` tells whether the dump was gzipped, once it has been read.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.gzip = False
+        super(SqlSource, self).__init__()
+
+    def generate(self):
+        data = self.source.read(CHUNK_SIZE)
+        decompressor = None
+        if data != pycurl.READFUNC_ABORT and data.startswith(GZIP_MAGIC):
+            self.gzip = True
+            decompressor = zlib.decompressobj(GZIP_WBITS)
+        head = True
+        while data and data != pycurl.READFUNC_ABORT:
+            if decompressor:
+                chunk = decompressor.decompress(data)
+                while decompressor.unused_data:
+                    # concatenated gzip members:
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(GZIP_WBITS)
+                    chunk += decompressor.decompress(data)
+                data = chunk
+            if head and data:
+                head = False
+                if (data.startswith(b'PGDMP') or
+                        data.startswith(b'PK\x03\x04')):
+                    self.error = ("Only plain SQL dumps (pg_dump "
+                                  "--format=plain) can be filtered or zipped")
+                    return
+            yield data
+            data = self.source.read(CHUNK_SIZE)
+        if data == pycurl.READFUNC_ABORT or self.source.error:
+            self.error = self.source.error or "Could not read the dump"
+
+    def close(self):
+        self.source.close()
+
+
+def copy_table(line):
+    """The table name of a 'COPY schema.table (...) FROM stdin;' line"""
+    return line.split(None, 2)[1].replace(b'"', b'')
+
+
+class TableFilterSource(ChunkedSource):
+    """Drop the data of some tables from a plain SQL dump (gzipped or not)
+    on its way to the upload.
+
+    The COPY statements of the excluded tables are kept, but their rows are
+    skipped: the tables are restored empty. ``patterns`` are shell-style
+    patterns matched against 'schema.table' and 'table'. The number of bytes
+    dropped per table is kept in ``dropped``.
+    """
+
+    def __init__(self, source, patterns, compress=True):
+        self.source = SqlSource(source)
+        self.patterns = patterns
+        # gzip the filtered dump again if it was gzipped:
+        self.compress = compress
+        self.dropped = {}
+        super(TableFilterSource, self).__init__()
+
+    def excluded(self, table):
+        names = [table, table.split(b'.', 1)[-1]]
+        return any(fnmatch.fnmatchcase(name, pattern)
+                   for name in names for pattern in self.patterns)
+
+    def _lines(self):
+        rest = b''
+        for chunk in self.source.chunks:
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line + b'\n'
+        if rest:
+            yield rest
+
+    def _filter(self):
+        """The filtered lines of the dump, in chunks"""
+        pieces = []
+        length = 0
+        dropping = None
+        for line in self._lines():
+            if dropping:
+                if line.rstrip(b'\r\n') == b'\\.':
+                    dropping = None
+                else:
+                    self.dropped[dropping] += len(line)
+                    continue
+            elif line.startswith(b'COPY '):
+                table = copy_table(line)
+                if self.excluded(table):
+                    dropping = table
+                    self.dropped.setdefault(table, 0)
+            pieces.append(line)
+            length += len(line)
+            if length >= CHUNK_SIZE:
+                yield b''.join(pieces)
+                pieces = []
+                length = 0
+        if pieces:
+            yield b''.join(pieces)
+
+    def generate(self):
+        compressor = None
+        for chunk in self._filter():
+            if compressor is None and self.compress and self.source.gzip:
+                compressor = zlib.compressobj(
+                    6, zlib.DEFLATED, GZIP_WBITS)
+            yield compressor.compress(chunk) if compressor else chunk
+        if self.source.error:
+            self.error = self.source.error
+        elif compressor:
+            yield compressor.flush()
+
+    def close(self):
+        self.source.close()
+
+
+class UrlSource(object):
+    """Relay a dump downloaded from an http(s) URL (e.g. a pre-signed
+    object store URL) to the upload, without staging it on disk.
+
+    Both transfers run in the same CurlMulti loop (see ``relay``) and go
+    through a bounded in-memory buffer: the download is paused when the
+    buffer is full, the upload when it is empty.
+    """
+    size = None
+
+    def __init__(self, url, curl):
+        self.error = None
+        self.done = False
+        self.buffer = collections.deque()
+        self.length = 0
+        self.download_paused = False
+        self.upload_paused = False
+        self.curl = curl
+        curl.setopt(pycurl.URL, url)
+        curl.setopt(pycurl.FOLLOWLOCATION, 1)
+        curl.setopt(pycurl.FAILONERROR, 1)
+        curl.setopt(pycurl.WRITEFUNCTION, self.write)
+
+    def write(self, data):
+        if self.length >= RELAY_BUFFER_SIZE:
+            # the data will be passed again once the download is resumed
+            self.download_paused = True
+            return pycurl.WRITEFUNC_PAUSE
+        self.buffer.append(data)
+        self.length += len(data)
+
+    def read(self, size):
+        if not self.buffer:
+            if self.error:
+                return pycurl.READFUNC_ABORT
+            if self.done:
+                return b''
+            self.upload_paused = True
+            return pycurl.READFUNC_PAUSE
+        pieces = []
+        length = 0
+        while self.buffer and length < size:
+            data = self.buffer.popleft()
+            if length + len(data) > size:
+                self.buffer.appendleft(data[size - length:])
+                data = data[:size - length]
+            pieces.append(data)
+            length += len(data)
+        self.length -= length
+        return b''.join(pieces)
+
+    def relay(self, upload):
+        """Perform the download and the ``upload`` curl handle together.
+        Raise pycurl.error if the upload fails, like Curl.perform()."""
+        multi = pycurl.CurlMulti()
+        multi.add_handle(self.curl)
+        multi.add_handle(upload)
+        upload_done = False
+        upload_error = None
+        try:
+            while not upload_done:
+                while True:
+                    ret, num_handles = multi.perform()
+                    if ret != pycurl.E_CALL_MULTI_PERFORM:
+                        break
+
+                while True:
+                    num_q, ok_list, err_list = multi.info_read()
+                    for curl in ok_list:
+                        if curl is self.curl:
+                            self.done = True
+                        else:
+                            upload_done = True
+                    for curl, errno, errmsg in err_list:
+                        if curl is self.curl:
+                            self.error = "Could not download the dump: {}".format(errmsg)
+                            self.done = True
+                        else:
+                            upload_done = True
+                            upload_error = (errno, errmsg)
+                    if num_q == 0:
+                        break
+
+                if self.upload_paused and (self.buffer or self.done):
+                    self.upload_paused = False
+                    upload.pause(pycurl.PAUSE_CONT)
+                if self.download_paused and self.length < RELAY_BUFFER_SIZE:
+                    self.download_paused = False
+                    self.curl.pause(pycurl.PAUSE_CONT)
+
+                if not upload_done:
+                    multi.select(1.0)
+        finally:
+            multi.remove_handle(self.curl)
+            multi.remove_handle(upload)
+            multi.close()
+        if upload_error:
+            raise pycurl.error(*upload_error)
+
+    def close(self):
+        self.curl.close()
+
+
+def is_compressed(head):
+    """Whether a file, given its first bytes, is already compressed"""
+    for offset, magic in COMPRESSED_MAGICS:
+        if head[offset:offset + len(magic)] == magic:
+            return True
+    if not head:
+        return False
+    return len(zlib.compress(head, 1)) > MIN_DEFLATE_RATIO * len(head)
+
+
+def dos_datetime(timestamp):
+    """The (time, date) of a timestamp in the zip (MS-DOS) format"""
+    t = time.localtime(max(timestamp, 315532800))    # no date before 1980
+    return ((t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+            ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday)
+
+
+class ZipSource(ChunkedSource):
+    """Stream an Odoo-style dump: a zip of the SQL dump (as ``dump.sql``)
+    and of the ``filestore`` directory, built on the fly.
+
+    The entries are written with data descriptors (their CRC and sizes are
+    only known once written) and ZIP64 extensions (a dump can be larger
+    than 4 GB). Files already compressed (images, archives, ...) are stored
+    rather than deflated.
+    """
+    ZIP64_VERSION = 45
+    ZIP64_LIMIT = 0xffffffff
+    FLAGS = 0x08 | 0x800      # data descriptor, utf-8 names
+
+    def __init__(self, dump, filestore):
+        self.dump = dump
+        self.sql = SqlSource(dump)
+        self.filestore = filestore
+        self.offset = 0
+        self.entries = []
+        self.stored = 0
+        super(ZipSource, self).__init__()
+
+    def _emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def _entry(self, name, chunks, mtime, mode, deflate):
+        name = name.encode('utf-8') if not isinstance(name, bytes) else name
+        dos_time, dos_date = dos_datetime(mtime)
+        method = zipfile.ZIP_DEFLATED if deflate else zipfile.ZIP_STORED
+        offset = self.offset
+        yield self._emit(struct.pack(
+            '<IHHHHHIIIHH', 0x04034b50, self.ZIP64_VERSION, self.FLAGS,
+            method, dos_time, dos_date, 0, self.ZIP64_LIMIT,
+            self.ZIP64_LIMIT, len(name), 20) + name +
+            struct.pack('<HHQQ', 0x0001, 16, 0, 0))
+
+        crc = 0
+        size = 0
+        compressed_size = 0
+        compressor = zlib.compressobj(
+            6, zlib.DEFLATED, -zlib.MAX_WBITS) if deflate else None
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            if compressor:
+                chunk = compressor.compress(chunk)
+            compressed_size += len(chunk)
+            if chunk:
+                yield self._emit(chunk)
+        if compressor:
+            chunk = compressor.flush()
+            compressed_size += len(chunk)
+            yield self._emit(chunk)
+        crc &= 0xffffffff
+
+        yield self._emit(struct.pack(
+            '<IIQQ', 0x08074b50, crc, compressed_size, size))
+        self.entries.append(
+            (name, method, dos_time, dos_date, crc, compressed_size, size,
+             offset, mode))
+
+    def _central_directory(self):
+        start = self.offset
+        for (name, method, dos_time, dos_date, crc, compressed_size, size,
+             offset, mode) in self.entries:
+            # the values too large for the header go in the zip64 field:
+            extra = [value for value in (size, compressed_size, offset)
+                     if value >= self.ZIP64_LIMIT]
+            extra = struct.pack(
+                '<HH' + 'Q' * len(extra), 0x0001, 8 * len(extra),
+                *extra) if extra else b''
+            yield self._emit(struct.pack(
+                '<IHHHHHHIIIHHHHHII', 0x02014b50,
+                (3 << 8) | self.ZIP64_VERSION, self.ZIP64_VERSION,
+                self.FLAGS, method, dos_time, dos_date, crc,
+                min(compressed_size, self.ZIP64_LIMIT),
+                min(size, self.ZIP64_LIMIT), len(name), len(extra), 0, 0, 0,
+                (mode & 0xffff) << 16, min(offset, self.ZIP64_LIMIT)) +
+                name + extra)
+        size = self.offset - start
+        count = len(self.entries)
+        if (count >= 0xffff or size >= self.ZIP64_LIMIT
+                or start >= self.ZIP64_LIMIT):
+            end = self.offset
+            yield self._emit(struct.pack(
+                '<IQHHIIQQQQ', 0x06064b50, 44, self.ZIP64_VERSION,
+                self.ZIP64_VERSION, 0, 0, count, count, size, start))
+            yield self._emit(struct.pack('<IIQI', 0x07064b50, 0, end, 1))
+        yield self._emit(struct.pack(
+            '<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xffff),
+            min(count, 0xffff), min(size, self.ZIP64_LIMIT),
+            min(start, self.ZIP64_LIMIT), 0))
+
+    def _filestore(self):
+        def walk_error(exc):
+            raise exc
+        for root, dirs, files in os.walk(self.filestore, onerror=walk_error):
+            dirs.sort()
+            for filename in sorted(files):
+                path = os.path.join(root, filename)
+                name = os.path.join(
+                    'filestore', os.path.relpath(path, self.filestore))
+                stat = os.stat(path)
+                with open(path, 'rb') as fp:
+                    head = fp.read(CHUNK_SIZE)
+                    deflate = not is_compressed(head)
+                    if not deflate:
+                        self.stored += 1
+                    chunks = itertools.chain(
+                        [head], iter(lambda: fp.read(CHUNK_SIZE), b''))
+                    for chunk in self._entry(name, chunks, stat.st_mtime,
+                                             stat.st_mode, deflate):
+                        yield chunk
+
+    def generate(self):
+        for chunk in self._entry('dump.sql', self.sql.chunks, time.time(),
+                                 0o100644, True):
+            yield chunk
+        if self.sql.error:
+            self.error = self.sql.error
+            return
+
+        try:
+            for chunk in self._filestore():
+                yield chunk
+        except (IOError, OSError) as exc:
+            # unreadable file or directory, or file removed in the meantime
+            self.error = "Could not read the filestore: {}".format(exc)
+            return
+
+        for chunk in self._central_directory():
+            yield chunk
+
+    def close(self):
+        self.dump.close()
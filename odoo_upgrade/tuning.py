@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+#-*- encoding: utf8 -*-
+
+"""
+Network tuning of the upload.
+
+The link to the upgrade platform is measured on the upload itself, rather
+than with test transfers: the kernel reports the round-trip time of the
+upload connection and how many bytes the server acknowledged (TCP_INFO,
+Linux only). After the first seconds of the upload, the socket send buffer
+of that connection is sized after the bandwidth-delay product of the link.
+"""
+
+import time
+import socket
+import struct
+
+import pycurl
+
+
+# the throughput is measured between these times of the upload (in
+# seconds), once the buffers along the way have been filled:
+MEASURE_START = 1
+MEASURE_END = 4
+
+# bounds of the socket send buffer:
+MIN_SNDBUF = 64 * 1024
+MAX_SNDBUF = 16 * 1024 * 1024
+# TCP keep-alive probes, so that long uploads survive idle NAT timeouts:
+TCP_KEEPALIVE = 60
+
+# offsets of tcpi_rtt (microseconds) and tcpi_bytes_acked in Linux's
+# struct tcp_info; the latter since Linux 4.1:
+TCPI_RTT_OFFSET = 68
+TCPI_BYTES_ACKED_OFFSET = 120
+
+
+def clamp(value, lower, upper):
+    return int(max(lower, min(upper, value)))
+
+
+def power_of_2(value):
+    power = 1
+    while power < value:
+        power *= 2
+    return power
+
+
+def tune(rtt, throughput):
+    """Upload settings for a link, sized after its bandwidth-delay product"""
+    settings = {'tcp_keepalive': TCP_KEEPALIVE}
+    if rtt and throughput:
+        bdp = rtt * throughput
+        settings['sndbuf'] = clamp(
+            power_of_2(2 * bdp), MIN_SNDBUF, MAX_SNDBUF)
+    return settings
+
+
+def tcp_info(fd):
+    """The round-trip time (in seconds) of a TCP connection and the number
+    of bytes acknowledged by the peer, or None if the kernel doesn't tell"""
+    if not hasattr(socket, 'TCP_INFO'):
+        return None
+    sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        info = sock.getsockopt(socket.IPPROTO_TCP, socket.TCP_INFO, 256)
+    except socket.error:
+        return None
+    finally:
+        # only closes the duplicate of the descriptor
+        sock.close()
+    if len(info) < TCPI_BYTES_ACKED_OFFSET + 8:
+        return None
+    rtt, = struct.unpack_from('I', info, TCPI_RTT_OFFSET)
+    acked, = struct.unpack_from('Q', info, TCPI_BYTES_ACKED_OFFSET)
+    return rtt / 1e6, acked
+
+
+def set_socket_options(fd, settings):
+    """Apply the settings to a connected socket"""
+    sock = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        if settings.get('sndbuf'):
+            sock.setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF, settings['sndbuf'])
+        if settings.get('tcp_keepalive'):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            if hasattr(socket, 'TCP_KEEPIDLE'):
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                                settings['tcp_keepalive'])
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                                settings['tcp_keepalive'])
+    finally:
+        sock.close()
+
+
+def apply_settings(curl, settings):
+    """Apply the settings to a curl handle, for the connections it will
+    open"""
+    if settings.get('buffer_size') and hasattr(pycurl, 'UPLOAD_BUFFERSIZE'):
+        curl.setopt(pycurl.UPLOAD_BUFFERSIZE, settings['buffer_size'])
+
+    if settings.get('tcp_keepalive'):
+        curl.setopt(pycurl.TCP_KEEPALIVE, 1)
+        curl.setopt(pycurl.TCP_KEEPIDLE, settings['tcp_keepalive'])
+        curl.setopt(pycurl.TCP_KEEPINTVL, settings['tcp_keepalive'])
+
+    if settings.get('sndbuf'):
+        def sockopt(fd, purpose):
+            set_socket_options(fd, {'sndbuf': settings['sndbuf']})
+            return 0
+        curl.setopt(pycurl.SOCKOPTFUNCTION, sockopt)
+
+
+class AutoTuner(object):
+    """Measure the link during an upload, and size the send buffer of its
+    connection after it.
+
+    The upload must run on a new connection (FRESH_CONNECT), with
+    ``sockopt`` as its SOCKOPTFUNCTION, and ``progress`` must be called from
+    its progress callback. The measures and the chosen send buffer are put
+    in ``settings``, unless it already holds an explicit ``sndbuf``.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.explicit = 'sndbuf' in settings
+        self.settings.update(rtt=None, throughput=None)
+        self.fd = -1
+        self.started = None
+        self.first = None
+        self.done = False
+
+    def sockopt(self, fd, purpose):
+        self.fd = fd
+        set_socket_options(fd, self.settings)
+        return 0
+
+    def progress(self, uploaded):
+        if self.done or not uploaded or self.fd == -1:
+            return
+        now = time.time()
+        if self.started is None:
+            self.started = now
+            return
+        if now - self.started < (MEASURE_END if self.first else MEASURE_START):
+            return
+        info = tcp_info(self.fd)
+        if info is None:
+            self.done = True
+            self.settings['measure_error'] = (
+                "The acknowledged bytes are not reported by this system")
+            return
+        if self.first is None:
+            self.first = now, info[1]
+            return
+
+        self.done = True
+        rtt, acked = info
+        start, first_acked = self.first
+        throughput = (acked - first_acked) / (now - start)
+        self.settings.update(rtt=rtt, throughput=throughput)
+        if not self.explicit:
+            sndbuf = tune(rtt, throughput).get('sndbuf')
+            if sndbuf:
+                self.settings['sndbuf'] = sndbuf
+                set_socket_options(self.fd, {'sndbuf': sndbuf})
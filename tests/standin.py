@@ -0,0 +1,133 @@
+#-*- encoding: utf8 -*-
+
+"""
+A local stand-in for the upgrade platform (or any HTTP server) to test
+odoo_upgrade against.
+
+Each test registers the responses of the paths it needs on the server:
+
+    server = StandInServer()
+    server.route('POST', '/database/v1/status', handler)
+
+where ``handler(request)`` returns a (code, headers, body) tuple. The
+received requests are kept in ``server.requests``.
+"""
+
+import json
+import time
+import threading
+import BaseHTTPServer
+import SocketServer
+from urlparse import urlparse, parse_qsl
+
+from odoo_upgrade.__main__ import parser
+
+
+class Request(object):
+    def __init__(self, handler, body):
+        url = urlparse(handler.path)
+        self.method = handler.command
+        self.path = url.path
+        self.query = dict(parse_qsl(url.query))
+        self.headers = handler.headers
+        self.body = body
+        self.client = handler.client_address
+
+    @property
+    def form(self):
+        return dict(parse_qsl(self.body))
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep-alive connections
+    protocol_version = 'HTTP/1.1'
+
+    def read_body(self):
+        if self.headers.getheader('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            throttle = self.server.throttle
+            while True:
+                size = int(self.rfile.readline().split(';')[0], 16)
+                if not size:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+                if throttle:
+                    time.sleep(float(size) / throttle)
+        length = int(self.headers.getheader('Content-Length') or 0)
+        body = []
+        while length > 0:
+            data = self.rfile.read(min(length, 64 * 1024))
+            if not data:
+                break
+            body.append(data)
+            length -= len(data)
+            if self.server.throttle:
+                time.sleep(float(len(data)) / self.server.throttle)
+        return b''.join(body)
+
+    def handle_request(self):
+        body = self.read_body() if self.command != 'HEAD' else b''
+        request = Request(self, body)
+        self.server.requests.append(request)
+        if self.server.delay:
+            time.sleep(self.server.delay)
+        handler = self.server.routes.get((self.command, request.path))
+        if handler:
+            code, headers, body = handler(request)
+        else:
+            code, headers, body = 404, {}, json.dumps({'error': 'Not found'})
+        self.send_response(code)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    do_GET = do_POST = do_HEAD = handle_request
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, throttle=None, delay=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.routes = {}
+        self.requests = []
+        # reading speed of the request bodies, in bytes per second:
+        self.throttle = throttle
+        # latency added to every response, in seconds:
+        self.delay = delay
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def route(self, method, path, handler):
+        self.routes[(method, path)] = handler
+
+    def handle_error(self, request, client_address):
+        # clients aborting their uploads are part of the tests
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def json_response(obj, code=200):
+    return code, {'Content-Type': 'application/json'}, json.dumps(obj)
+
+
+def make_args(server, *argv):
+    """Parse odoo_upgrade's command line, against a stand-in server"""
+    return parser.parse_args(list(argv) + ['-q', '--url', server.url])
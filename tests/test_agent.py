@@ -0,0 +1,183 @@
+#-*- encoding: utf8 -*-
+
+import os
+import json
+import shutil
+import httplib
+import threading
+import tempfile
+import unittest
+
+import pycurl
+
+from odoo_upgrade.agent import (
+    Agent, JobQueue, QUEUED, RUNNING, DONE, FAILED, REDACTED)
+from odoo_upgrade.odoo_upgrade import (
+    ERROR_HTTP_4xx, ERROR_INTERNAL, ERROR_MISSING_ARGUMENT)
+
+from .standin import StandInServer, json_response, make_args
+
+
+class TestAgent(unittest.TestCase):
+    def setUp(self):
+        self.spool = tempfile.mkdtemp()
+        self.server = StandInServer()
+        self.server.route('POST', '/database/v1/process', self.process)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.spool)
+
+    def process(self, request):
+        if request.form['key'] != 'secret':
+            return json_response({'error': 'Unknown request'}, 404)
+        return json_response({'request': {'id': 10042, 'state': 'pending'}})
+
+    def agent(self, *argv):
+        return Agent(make_args(
+            self.server, 'serve', '--spool', self.spool, *argv))
+
+    def run_jobs(self, agent):
+        curl = pycurl.Curl()
+        try:
+            while not agent.jobs.queue.empty():
+                agent.run_job(agent.jobs.queue.get(), curl)
+        finally:
+            curl.close()
+
+    def test_run_jobs(self):
+        agent = self.agent()
+        ok = agent.jobs.submit('process', {'key': 'secret', 'request': '10042'})
+        ko = agent.jobs.submit('process', {'key': 'wrong', 'request': '10042'})
+        self.run_jobs(agent)
+
+        ok = agent.jobs.get(ok['id'])
+        self.assertEqual(ok['state'], DONE)
+        self.assertEqual(ok['exitcode'], 0)
+        self.assertEqual(ok['output']['upgrade_response']['request']['state'],
+                         'pending')
+        ko = agent.jobs.get(ko['id'])
+        self.assertEqual(ko['state'], FAILED)
+        self.assertEqual(ko['exitcode'], ERROR_HTTP_4xx)
+        # both jobs ran on the same, warm, connection:
+        self.assertEqual(
+            len(set(request.client for request in self.server.requests)), 1)
+
+    def test_crash(self):
+        agent = self.agent()
+        # no dump: the upload can't even start
+        job = agent.jobs.submit('upload', {'key': 'secret', 'request': '1',
+                                           'dbdump': 'http://[::1'})
+        self.run_jobs(agent)
+        job = agent.jobs.get(job['id'])
+        self.assertEqual(job['state'], FAILED)
+        self.assertEqual(job['exitcode'], ERROR_INTERNAL)
+        self.assertTrue(job['error'])
+
+    def test_restart(self):
+        jobs = JobQueue(self.spool)
+        ids = dict((action, jobs.submit(action, {})['id'])
+                   for action in ('create', 'all', 'upload', 'status'))
+        for action in ('create', 'all', 'upload'):
+            jobs.update(ids[action], state=RUNNING)
+
+        # the agent is restarted:
+        jobs = JobQueue(self.spool)
+        requeued = []
+        while not jobs.queue.empty():
+            requeued.append(jobs.queue.get())
+        self.assertEqual(sorted(requeued),
+                         sorted([ids['upload'], ids['status']]))
+        for action in ('create', 'all'):
+            job = jobs.get(ids[action])
+            self.assertEqual(job['state'], FAILED)
+            self.assertEqual(job['exitcode'], ERROR_INTERNAL)
+            self.assertIn('Interrupted', job['error'])
+        self.assertEqual(jobs.get(ids['upload'])['state'], QUEUED)
+        # the failure is persisted:
+        with open(jobs._path(ids['create'])) as fp:
+            self.assertEqual(json.load(fp)['state'], FAILED)
+
+
+
+class TestControl(unittest.TestCase):
+    def setUp(self):
+        self.spool = tempfile.mkdtemp()
+        self.server = StandInServer()
+        self.agent = Agent(make_args(
+            self.server, 'serve', '--spool', self.spool, '--listen', '0'))
+        self.control = self.agent.control_server()
+        self.thread = threading.Thread(target=self.control.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.control.shutdown()
+        self.control.server_close()
+        self.server.stop()
+        shutil.rmtree(self.spool)
+
+    def call(self, method, path, body=None, token=None):
+        connection = httplib.HTTPConnection(*self.control.server_address)
+        headers = {'Authorization': 'Bearer ' + (token or self.agent.token)}
+        connection.request(method, path, body and json.dumps(body), headers)
+        response = connection.getresponse()
+        result = response.status, json.loads(response.read())
+        connection.close()
+        return result
+
+    def test_token(self):
+        # generated in the spool, only readable by the agent's user:
+        path = os.path.join(self.spool, 'token')
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+        with open(path) as fp:
+            self.assertEqual(fp.read().strip(), self.agent.token)
+        self.assertEqual(self.call('GET', '/jobs', token='wrong')[0], 401)
+        self.assertEqual(self.call('POST', '/jobs', {'action': 'process'},
+                                   token='wrong')[0], 401)
+        self.assertEqual(self.agent.jobs.list(), [])
+        self.assertEqual(self.call('GET', '/jobs'), (200, []))
+
+    def test_submit(self):
+        code, job = self.call('POST', '/jobs', {
+            'action': 'upload', 'key': 'secret', 'request': 10042,
+            'dbdump': '/backups/db.sql', 'exclude_table_data': 'mail_message'})
+        self.assertEqual(code, 201)
+        # a single pattern is taken as a list of one:
+        self.assertEqual(job['params']['exclude_table_data'], ['mail_message'])
+        self.assertEqual(
+            self.agent.jobs.get(job['id'])['params']['key'], 'secret')
+        # the private key is not displayed:
+        self.assertEqual(job['params']['key'], REDACTED)
+        code, jobs = self.call('GET', '/jobs')
+        self.assertEqual(jobs[0]['params']['key'], REDACTED)
+        code, job = self.call('GET', '/jobs/' + job['id'])
+        self.assertEqual(job['params']['key'], REDACTED)
+
+    def test_invalid(self):
+        for params in [{'action': 'upload', 'exclude_table_data': [1]},
+                       {'action': 'upload', 'dbdump': ['a', 'b']},
+                       {'action': 'upload', 'request': True},
+                       {'action': 'upload', 'owner': 'me'},
+                       {'action': 'drop'}]:
+            code, result = self.call('POST', '/jobs', params)
+            self.assertEqual(code, 400)
+            self.assertTrue(result['error'])
+        self.assertEqual(self.agent.jobs.list(), [])
+
+    def test_listen(self):
+        # not beyond the local host without an explicit token file:
+        agent = Agent(make_args(self.server, 'serve', '--spool', self.spool,
+                                '--listen', '0.0.0.0:0'))
+        self.assertIsNone(agent.control_server())
+        self.assertEqual(agent.serve(), ERROR_MISSING_ARGUMENT)
+
+        path = os.path.join(self.spool, 'token')
+        os.chmod(path, 0o644)
+        with self.assertRaises(ValueError):
+            Agent(make_args(self.server, 'serve', '--spool', self.spool,
+                            '--token-file', path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+#-*- encoding: utf8 -*-
+
+import os
+import gzip
+import shutil
+import zipfile
+import tempfile
+import unittest
+from io import BytesIO
+
+from odoo_upgrade.odoo_upgrade import UpgradeManager, ERROR_DUMP
+
+from .standin import StandInServer, json_response, make_args
+
+
+DUMP = b'CREATE TABLE res_partner (id integer);\n' * 1000
+
+
+class TestFilestore(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.route('POST', '/database/v1/upload', self.upload)
+        self.tmp = tempfile.mkdtemp()
+        self.filestore = os.path.join(self.tmp, 'filestore')
+        os.makedirs(os.path.join(self.filestore, 'ab'))
+        with open(os.path.join(self.filestore, 'ab', 'abcdef'), 'wb') as fp:
+            fp.write(b'attachment\n' * 100)
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmp)
+
+    def upload(self, request):
+        return json_response({'request': {'id': 10042, 'state': 'draft'}})
+
+    def write_dump(self, name, data):
+        path = os.path.join(self.tmp, name)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(path, 'wb') as fp:
+            fp.write(data)
+        return path
+
+    def manager(self, dump):
+        return UpgradeManager(make_args(
+            self.server, 'upload', '--key', 'key', '--request', '10042',
+            '--dbdump', dump, '--filestore', self.filestore))
+
+    def test_zip(self):
+        manager = self.manager(self.write_dump('db.2024-10-01.sql.gz', DUMP))
+        self.assertEqual(manager.dump_filename(), 'db.2024-10-01.zip')
+        self.assertFalse(manager.dispatch())
+        self.assertEqual(manager.output['filestore']['files'], 1)
+
+        archive = zipfile.ZipFile(BytesIO(self.server.requests[0].body))
+        self.assertEqual(sorted(archive.namelist()),
+                         ['dump.sql', 'filestore/ab/abcdef'])
+        self.assertEqual(archive.read('dump.sql'), DUMP)
+        self.assertIsNone(archive.testzip())
+
+    def test_custom_format(self):
+        for name, data in [('db.dump', b'PGDMP\x01\x0e\x00' + DUMP),
+                           ('db.sql.gz', b'PGDMP\x01\x0e\x00' + DUMP),
+                           ('db.zip', b'PK\x03\x04' + DUMP)]:
+            manager = self.manager(self.write_dump(name, data))
+            self.assertEqual(manager.dispatch(), ERROR_DUMP)
+
+    def test_unreadable_dump(self):
+        # the table filter aborts on its first read
+        manager = self.manager(self.write_dump('db.dump', b'PGDMP' + DUMP))
+        manager.args.exclude_table_data = ['mail_message']
+        self.assertEqual(manager.dispatch(), ERROR_DUMP)
+
+    def test_filtered_dump(self):
+        # the filtered dump is zipped as plain SQL, not gzipped again
+        dump = self.write_dump('db.sql.gz', DUMP + b'COPY public.mail_message '
+                               b'(id) FROM stdin;\n1\n\\.\n')
+        manager = self.manager(dump)
+        manager.args.exclude_table_data = ['mail_message']
+        self.assertFalse(manager.dispatch())
+        self.assertEqual(manager.output['excluded_table_data'],
+                         {'public.mail_message': 2})
+        archive = zipfile.ZipFile(BytesIO(self.server.requests[0].body))
+        self.assertEqual(archive.read('dump.sql'), DUMP + b'COPY '
+                         b'public.mail_message (id) FROM stdin;\n\\.\n')
+
+    def test_corrupt_gzip(self):
+        dump = self.write_dump('db.sql', b'\x1f\x8b' + os.urandom(4096))
+        self.assertEqual(self.manager(dump).dispatch(), ERROR_DUMP)
+
+    def test_unreadable_filestore(self):
+        # a file removed while the filestore is being walked:
+        os.symlink(os.path.join(self.tmp, 'removed'),
+                   os.path.join(self.filestore, 'ab', 'abcdeg'))
+        manager = self.manager(self.write_dump('db.sql', DUMP))
+        self.assertEqual(manager.dispatch(), ERROR_DUMP)
+
+    def test_flight_key(self):
+        dump = self.write_dump('db.sql', DUMP)
+        other = os.path.join(self.tmp, 'other')
+        os.symlink(self.filestore, os.path.join(self.tmp, 'link'))
+        os.mkdir(other)
+        key = self.manager(dump).flight_key()
+        manager = self.manager(dump)
+        manager.args.filestore = other
+        self.assertNotEqual(manager.flight_key(), key)
+        manager.args.filestore = os.path.join(self.tmp, 'link')
+        self.assertEqual(manager.flight_key(), key)
+        manager.args.filestore = None
+        self.assertNotEqual(manager.flight_key(), key)
+
+
+if __name__ == '__main__':
+    unittest.main()
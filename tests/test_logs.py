@@ -0,0 +1,100 @@
+#-*- encoding: utf8 -*-
+
+import sys
+import unittest
+from io import BytesIO
+
+from odoo_upgrade import odoo_upgrade
+from odoo_upgrade.odoo_upgrade import UpgradeManager
+
+from .standin import StandInServer, json_response, make_args
+
+
+LOG = b'line 1\nline 2\nline 3\n'
+
+
+class TestLogs(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        # honour the Range header by default:
+        self.ranges = True
+        self.server.route('GET', '/database/v1/logs', self.log)
+        self.stdout = sys.stdout
+        sys.stdout = BytesIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        self.server.stop()
+
+    def log(self, request):
+        if request.query.get('key') != 'key':
+            return json_response({'error': 'Unknown request'}, 404)
+        headers = {'Content-Type': 'text/plain'}
+        start = int(request.headers.getheader('Range')[6:-1])
+        if not self.ranges:
+            return 200, headers, LOG
+        if start >= len(LOG):
+            return 416, headers, b''
+        headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+            start, len(LOG) - 1, len(LOG))
+        return 206, headers, LOG[start:]
+
+    def logs(self, *argv):
+        manager = UpgradeManager(make_args(
+            self.server, 'logs', '--request', '1', *argv))
+        return manager, manager.dispatch()
+
+    def test_partial_content(self):
+        manager, exitcode = self.logs('--key', 'key', '--offset', '7')
+        self.assertFalse(exitcode)
+        self.assertEqual(sys.stdout.getvalue(), LOG[7:])
+        self.assertEqual(manager.output['http_status']['code'], 206)
+        self.assertEqual(manager.output['offset'], len(LOG))
+
+    def test_range_ignored(self):
+        # the whole log is sent: what is before the offset is skipped
+        self.ranges = False
+        manager, exitcode = self.logs('--key', 'key', '--offset', '7')
+        self.assertFalse(exitcode)
+        self.assertEqual(sys.stdout.getvalue(), LOG[7:])
+        self.assertEqual(manager.output['http_status']['code'], 200)
+        self.assertEqual(manager.output['offset'], len(LOG))
+
+    def test_nothing_new(self):
+        manager, exitcode = self.logs(
+            '--key', 'key', '--offset', str(len(LOG)))
+        self.assertFalse(exitcode)
+        self.assertEqual(sys.stdout.getvalue(), b'')
+        self.assertEqual(manager.output['http_status']['code'], 416)
+        self.assertEqual(manager.output['offset'], len(LOG))
+
+    def test_follow(self):
+        # the second poll fails: the offset reached so far is still output
+        def log(request):
+            if len(self.server.requests) > 1:
+                self.server.route('GET', '/database/v1/logs', self.log)
+                return json_response({'error': 'Unknown request'}, 404)
+            return self.log(request)
+        self.server.route('GET', '/database/v1/logs', log)
+        manager, exitcode = self.logs(
+            '--key', 'key', '--follow', '--interval', '0.01')
+        self.assertEqual(exitcode, odoo_upgrade.ERROR_HTTP_4xx)
+        self.assertEqual(sys.stdout.getvalue(), LOG)
+        self.assertEqual(manager.output['offset'], len(LOG))
+        self.assertEqual(manager.output['upgrade_response'],
+                         {'error': 'Unknown request'})
+        self.assertEqual(
+            [request.headers.getheader('Range')
+             for request in self.server.requests],
+            ['bytes=0-', 'bytes={}-'.format(len(LOG))])
+
+    def test_transfer_error(self):
+        self.server.stop()
+        manager, exitcode = self.logs('--key', 'key', '--offset', '7')
+        self.assertEqual(exitcode, odoo_upgrade.ERROR_TRANSFER)
+        self.assertIn('error', manager.output)
+        self.assertEqual(manager.output['offset'], 7)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,228 @@
+#-*- encoding: utf8 -*-
+
+import os
+import time
+import stat
+import shutil
+import tarfile
+import tempfile
+import unittest
+import subprocess
+from io import BytesIO
+from distutils.spawn import find_executable
+
+from odoo_upgrade.odoo_upgrade import (
+    UpgradeManager, ERROR_DUMP, ERROR_HTTP_4xx)
+
+from .standin import StandInServer, json_response, make_args
+
+
+# writes 3 table files in parallel, slowly, then the toc:
+FAKE_PG_DUMP = """#!/bin/sh
+while [ "$1" != "--file" ]; do shift; done
+dir="$2"
+mkdir "$dir"
+for i in 1 2 3; do
+    ( exec 3>"$dir/300$i.dat.gz"
+      for j in 1 2 3; do echo "row $i $j" >&3; sleep 0.2; done ) &
+done
+wait
+echo toc > "$dir/toc.dat"
+"""
+FAILING_PG_DUMP = """#!/bin/sh
+while [ "$1" != "--file" ]; do shift; done
+mkdir "$2"
+echo partial > "$2/3001.dat.gz"
+exit 1
+"""
+
+
+class PgDumpTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.route('POST', '/database/v1/upload', self.upload)
+        self.tmp = tempfile.mkdtemp()
+        self.bin = os.path.join(self.tmp, 'bin')
+        self.scratch = os.path.join(self.tmp, 'scratch')
+        os.mkdir(self.bin)
+        os.mkdir(self.scratch)
+        self.path = os.environ['PATH']
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        self.server.stop()
+        shutil.rmtree(self.tmp)
+
+    def upload(self, request):
+        return json_response({'request': {'id': 10042, 'state': 'draft'}})
+
+    def install_pg_dump(self, script):
+        path = os.path.join(self.bin, 'pg_dump')
+        with open(path, 'w') as fp:
+            fp.write(script)
+        os.chmod(path, stat.S_IRWXU)
+        os.environ['PATH'] = self.bin + os.pathsep + self.path
+
+    def run_upload(self, dbname='db'):
+        manager = UpgradeManager(make_args(
+            self.server, 'upload', '--key', 'secret', '--request', '10042',
+            '--pgdump', dbname, '--pgdump-jobs', '3',
+            '--pgdump-dir', self.scratch))
+        return manager.dispatch()
+
+    def uploaded_tar(self):
+        request, = self.server.requests
+        self.assertEqual(request.headers.getheader('Transfer-Encoding'),
+                         'chunked')
+        return tarfile.open(fileobj=BytesIO(request.body))
+
+
+class TestPgDumpSource(PgDumpTestCase):
+    def test_stream(self):
+        self.install_pg_dump(FAKE_PG_DUMP)
+        self.assertFalse(self.run_upload())
+        tar = self.uploaded_tar()
+        self.assertEqual(
+            sorted(tar.getnames()),
+            ['db', 'db/3001.dat.gz', 'db/3002.dat.gz', 'db/3003.dat.gz',
+             'db/toc.dat'])
+        # the table files were complete when packed:
+        self.assertEqual(tar.extractfile('db/3002.dat.gz').read(),
+                         'row 2 1\nrow 2 2\nrow 2 3\n')
+        self.assertEqual(tar.getnames()[-1], 'db/toc.dat')
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_pg_dump_fails(self):
+        self.install_pg_dump(FAILING_PG_DUMP)
+        self.assertEqual(self.run_upload(), ERROR_DUMP)
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_pg_dump_missing(self):
+        os.environ['PATH'] = self.bin
+        self.assertEqual(self.run_upload(), ERROR_DUMP)
+        self.assertEqual(self.server.requests, [])
+        self.assertEqual(os.listdir(self.scratch), [])
+
+
+class TestPipeline(PgDumpTestCase):
+    """all --pgdump --pipeline"""
+
+    def setUp(self):
+        super(TestPipeline, self).setUp()
+        # written by pg_dump as soon as it starts:
+        self.started = os.path.join(self.tmp, 'started')
+        self.install_pg_dump(FAKE_PG_DUMP.replace(
+            '#!/bin/sh\n', '#!/bin/sh\ntouch {}\n'.format(self.started)))
+        self.create_status = 200
+        self.server.route('POST', '/database/v1/create', self.create)
+        self.server.route('POST', '/database/v1/process', self.reply)
+        self.server.route('POST', '/database/v1/status', self.reply)
+
+    def create(self, request):
+        # the dump is already being produced
+        time.sleep(0.1)
+        self.dumping = os.path.exists(self.started)
+        if self.create_status != 200:
+            return json_response({'error': 'Invalid contract'},
+                                 self.create_status)
+        return json_response(
+            {'request': {'id': 10042, 'key': 'secret', 'state': 'draft'}})
+
+    def reply(self, request):
+        return json_response({'request': {'id': 10042, 'state': 'pending'}})
+
+    def run_all(self):
+        manager = UpgradeManager(make_args(
+            self.server, 'all', '--contract', 'contract', '--email',
+            'john.doe@example.com', '--target', '12.0', '--aim', 'test',
+            '--pgdump', 'db', '--pgdump-jobs', '3',
+            '--pgdump-dir', self.scratch, '--pipeline'))
+        return manager.dispatch()
+
+    def test_pipeline(self):
+        self.assertFalse(self.run_all())
+        self.assertTrue(self.dumping)
+        self.assertEqual(
+            [request.path for request in self.server.requests],
+            ['/database/v1/create', '/database/v1/upload',
+             '/database/v1/process', '/database/v1/status'])
+        # all the operations on a single connection:
+        self.assertEqual(
+            len(set(request.client for request in self.server.requests)), 1)
+        self.assertEqual(self.server.requests[1].query,
+                         {'key': 'secret', 'request': '10042'})
+        self.assertEqual(os.listdir(self.scratch), [])
+
+    def test_create_fails(self):
+        self.create_status = 400
+        with self.assertRaises(SystemExit) as cm:
+            self.run_all()
+        self.assertEqual(cm.exception.code, ERROR_HTTP_4xx)
+        self.assertTrue(self.dumping)
+        # nothing uploaded, pg_dump stopped and its directory removed:
+        self.assertEqual([request.path for request in self.server.requests],
+                         ['/database/v1/create'])
+        self.assertEqual(os.listdir(self.scratch), [])
+
+
+POSTGRES_TOOLS = ['initdb', 'pg_ctl', 'pg_dump', 'pg_restore', 'psql']
+
+
+@unittest.skipUnless(all(find_executable(tool) for tool in POSTGRES_TOOLS),
+                     "PostgreSQL is not installed")
+class TestPgDumpPostgres(PgDumpTestCase):
+    """Against a throwaway local PostgreSQL cluster"""
+
+    def setUp(self):
+        super(TestPgDumpPostgres, self).setUp()
+        self.data = os.path.join(self.tmp, 'data')
+        self.env = dict(os.environ, PGHOST=self.tmp, PGPORT='54329',
+                        PGUSER='postgres')
+        self.env.pop('PGDATABASE', None)
+        devnull = open(os.devnull, 'w')
+        subprocess.check_call(
+            ['initdb', '-D', self.data, '-U', 'postgres', '-A', 'trust'],
+            stdout=devnull, stderr=devnull)
+        subprocess.check_call(
+            ['pg_ctl', '-D', self.data, '-w', '-l',
+             os.path.join(self.tmp, 'log'), '-o',
+             "-k {} -p 54329 -c listen_addresses=''".format(self.tmp),
+             'start'], stdout=devnull, env=self.env)
+        self.psql('postgres', 'CREATE DATABASE db')
+        self.psql('db', """
+            CREATE TABLE partner AS
+                SELECT i AS id, 'partner ' || i AS name
+                FROM generate_series(1, 10000) i;
+            CREATE TABLE message AS
+                SELECT i AS id, repeat('x', 500) AS body
+                FROM generate_series(1, 10000) i;""")
+        self.old_env = dict(os.environ)
+        os.environ.update(self.env)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.old_env)
+        subprocess.call(['pg_ctl', '-D', self.data, '-w', '-m', 'fast',
+                         'stop'], stdout=open(os.devnull, 'w'), env=self.env)
+        super(TestPgDumpPostgres, self).tearDown()
+
+    def psql(self, dbname, sql):
+        subprocess.check_call(['psql', '-q', '-d', dbname, '-c', sql],
+                              env=self.env)
+
+    def test_restore(self):
+        self.assertFalse(self.run_upload())
+        extract = os.path.join(self.tmp, 'extract')
+        self.uploaded_tar().extractall(extract)
+        self.psql('postgres', 'CREATE DATABASE restored')
+        subprocess.check_call(
+            ['pg_restore', '-d', 'restored', os.path.join(extract, 'db')],
+            env=self.env)
+        count = subprocess.check_output(
+            ['psql', '-tA', '-d', 'restored', '-c',
+             'SELECT count(*) FROM message'], env=self.env)
+        self.assertEqual(count.strip(), '10000')
+
+
+if __name__ == '__main__':
+    unittest.main()
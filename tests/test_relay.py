@@ -0,0 +1,56 @@
+#-*- encoding: utf8 -*-
+
+import os
+import unittest
+
+from odoo_upgrade import odoo_upgrade, sources
+from odoo_upgrade.odoo_upgrade import UpgradeManager
+
+from .standin import StandInServer, json_response, make_args
+
+
+# larger than the relay buffer, so that the download gets paused:
+DUMP = os.urandom(1024 * 1024) * (sources.RELAY_BUFFER_SIZE // (1024 * 1024) + 4)
+
+
+class TestRelay(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.route('GET', '/bucket/db.sql.gz',
+                          lambda request: (200, {}, DUMP))
+        self.server.route('POST', '/database/v1/upload', self.upload)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def upload(self, request):
+        return json_response({'request': {'id': int(request.query['request']),
+                                          'state': 'pending'}})
+
+    def relay(self, path):
+        manager = UpgradeManager(make_args(
+            self.server, 'upload', '--key', 'key', '--request', '10042',
+            '--dbdump', self.server.url + path + '?signature=secret'))
+        return manager, manager.dispatch()
+
+    def test_relay(self):
+        manager, exitcode = self.relay('/bucket/db.sql.gz')
+        self.assertFalse(exitcode)
+        self.assertEqual(manager.output['http_status']['code'], 200)
+        download, upload = self.server.requests
+        self.assertEqual(download.query, {'signature': 'secret'})
+        self.assertEqual(upload.headers.getheader('Transfer-Encoding'),
+                         'chunked')
+        self.assertEqual(len(upload.body), len(DUMP))
+        self.assertTrue(upload.body == DUMP)
+
+    def test_download_error(self):
+        manager, exitcode = self.relay('/bucket/missing.sql.gz')
+        self.assertEqual(exitcode, odoo_upgrade.ERROR_DUMP)
+        # the upload was aborted:
+        self.assertEqual([request.path for request in self.server.requests],
+                         ['/bucket/missing.sql.gz'])
+
+
+if __name__ == '__main__':
+    unittest.main()
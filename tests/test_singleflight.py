@@ -0,0 +1,146 @@
+#-*- encoding: utf8 -*-
+
+import os
+import time
+import fcntl
+import shutil
+import tempfile
+import unittest
+import threading
+
+from odoo_upgrade import singleflight
+from odoo_upgrade.singleflight import SingleFlight
+from odoo_upgrade.__main__ import parser
+from odoo_upgrade.odoo_upgrade import UpgradeManager
+
+
+class TestFlightKey(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.dump = os.path.join(self.tmp, 'db.sql')
+        with open(self.dump, 'w') as fp:
+            fp.write('SELECT 1;\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def key(self, *argv):
+        args = parser.parse_args(
+            ['upload', '-q', '--key', 'key', '--request', '10042',
+             '--dbdump', self.dump] + list(argv))
+        return UpgradeManager(args).flight_key()
+
+    def test_exclude_table_data(self):
+        plain = self.key()
+        excluded = self.key('--exclude-table-data', 'mail_*',
+                            '--exclude-table-data', 'ir_attachment')
+        self.assertNotEqual(plain, excluded)
+        # whatever the order of the patterns:
+        self.assertEqual(excluded, self.key(
+            '--exclude-table-data', 'ir_attachment',
+            '--exclude-table-data', 'mail_*'))
+        self.assertNotEqual(excluded, self.key(
+            '--exclude-table-data', 'mail_*'))
+
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+        self.poll_interval = singleflight.POLL_INTERVAL
+        singleflight.POLL_INTERVAL = 0.05
+        self.runs = []
+
+    def tearDown(self):
+        singleflight.POLL_INTERVAL = self.poll_interval
+        shutil.rmtree(self.lock_dir)
+
+    def flight(self):
+        return SingleFlight(self.lock_dir, 'upload:key')
+
+    def operation(self, output='follower'):
+        def operation():
+            self.runs.append(output)
+            return 0, {'by': output}
+        return operation
+
+    def in_child(self, target):
+        """Run ``target`` in a child process, once it is started. The child
+        exits (releasing its locks) when ``target`` returns."""
+        rfd, wfd = os.pipe()
+        pid = os.fork()
+        if not pid:
+            try:
+                os.close(rfd)
+                target(lambda: os.write(wfd, b'x'))
+            finally:
+                os._exit(0)
+        os.close(wfd)
+        os.read(rfd, 1)
+        os.close(rfd)
+        return pid
+
+    def test_attach(self):
+        started = threading.Event()
+        progress = []
+
+        def lead():
+            def operation():
+                flight.progress('50%')
+                started.set()
+                time.sleep(0.3)
+                return 1, {'by': 'leader'}
+            flight = self.flight()
+            flight.run(operation)
+        leader = threading.Thread(target=lead)
+        leader.start()
+        started.wait()
+
+        state, attached = self.flight().run(self.operation(), progress.append)
+        leader.join()
+        self.assertTrue(attached)
+        self.assertEqual(self.runs, [])
+        self.assertEqual(state['exitcode'], 1)
+        self.assertEqual(state['output'], {'by': 'leader'})
+        self.assertEqual(progress[0]['progress'], '50%')
+
+    def test_leader_dies(self):
+        # the leader dies without a result: the follower takes over
+        def lead(ready):
+            def operation():
+                ready()
+                time.sleep(0.3)
+                os._exit(1)
+            self.flight().run(operation)
+        pid = self.in_child(lead)
+        state, attached = self.flight().run(self.operation())
+        os.waitpid(pid, 0)
+        self.assertFalse(attached)
+        self.assertEqual(self.runs, ['follower'])
+        self.assertEqual(state['output'], {'by': 'follower'})
+        self.assertEqual(state['pid'], os.getpid())
+
+    def test_stale_state(self):
+        # the result of a previous run is not taken
+        self.flight().run(self.operation('previous'))
+        state, attached = self.flight().run(self.operation())
+        self.assertFalse(attached)
+        self.assertEqual(self.runs, ['previous', 'follower'])
+
+        # nor while waiting for an invocation which dies before publishing
+        # its own state
+        def lock(ready):
+            with open(self.flight().lock_path, 'a') as fp:
+                fcntl.flock(fp, fcntl.LOCK_EX)
+                ready()
+                time.sleep(0.3)
+        pid = self.in_child(lock)
+        state, attached = self.flight().run(self.operation('last'))
+        os.waitpid(pid, 0)
+        self.assertFalse(attached)
+        self.assertEqual(self.runs, ['previous', 'follower', 'last'])
+        self.assertEqual(state['output'], {'by': 'last'})
+
+
+if __name__ == '__main__':
+    unittest.main()
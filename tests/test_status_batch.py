@@ -0,0 +1,71 @@
+#-*- encoding: utf8 -*-
+
+import os
+import tempfile
+import unittest
+
+from odoo_upgrade import odoo_upgrade
+from odoo_upgrade.odoo_upgrade import UpgradeManager
+
+from .standin import StandInServer, json_response, make_args
+
+
+class TestStatusBatch(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer(delay=0.05)
+        self.server.route('POST', '/database/v1/status', self.status)
+        fd, self.batch = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        self.server.stop()
+        os.unlink(self.batch)
+
+    def status(self, request):
+        form = request.form
+        if form['key'] != 'key' + form['request']:
+            return json_response({'error': 'Unknown request'}, 404)
+        return json_response(
+            {'request': {'id': int(form['request']), 'state': 'done'}})
+
+    def write_batch(self, lines):
+        with open(self.batch, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+
+    def test_batch(self):
+        self.write_batch(['# key request', 'key9 9', '', 'key10 10',
+                          'key100 100', 'wrong 7'])
+        manager = UpgradeManager(make_args(
+            self.server, 'status', '--batch', self.batch,
+            '--max-streams', '2'))
+        exitcode = manager.dispatch()
+
+        rows = manager.output['upgrade_response']
+        # in the order of the batch file:
+        self.assertEqual([row['request'] for row in rows],
+                         ['9', '10', '100', '7'])
+        self.assertEqual([row['state'] for row in rows],
+                         ['done', 'done', 'done', None])
+        self.assertEqual(rows[3]['http_status']['code'], 404)
+        if odoo_upgrade.HTTP_VERSION_INFO is not None:
+            # the stand-in server only speaks HTTP/1.1:
+            self.assertEqual([row['http_version'] for row in rows],
+                             ['1.1'] * 4)
+        self.assertEqual(exitcode, odoo_upgrade.ERROR_HTTP_4xx)
+        # keep-alive connections, at most --max-streams of them:
+        clients = set(request.client for request in self.server.requests)
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertLessEqual(len(clients), 2)
+
+    def test_malformed_line(self):
+        self.write_batch(['key9 9', 'key10'])
+        manager = UpgradeManager(make_args(
+            self.server, 'status', '--batch', self.batch))
+        with self.assertRaises(SystemExit) as cm:
+            manager.dispatch()
+        self.assertEqual(cm.exception.code, odoo_upgrade.ERROR_MISSING_ARGUMENT)
+        self.assertEqual(self.server.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#-*- encoding: utf8 -*-
+
+import os
+import zlib
+import shutil
+import tempfile
+import unittest
+
+from odoo_upgrade.odoo_upgrade import (
+    UpgradeManager, ERROR_DUMP, ERROR_MISSING_ARGUMENT)
+from odoo_upgrade.sources import GZIP_WBITS
+
+from .standin import StandInServer, json_response, make_args
+
+
+HEAD = b'SET statement_timeout = 0;\n'
+PARTNERS = (b'COPY public.res_partner (id, name) FROM stdin;\n'
+            b'1\tAdmin\n'
+            b'\\.\n')
+MESSAGES = (b'COPY public.mail_message (id, body) FROM stdin;\n'
+            b'1\thello\n'
+            b'2\tworld\n'
+            b'\\.\n')
+AUDIT = (b'COPY audit.mail_message (id) FROM stdin;\n'
+         b'1\n'
+         b'\\.\n')
+ATTACHMENTS = (b'COPY public."ir_attachment" (id, datas) FROM stdin;\n' +
+               b'1\t' + b'x' * 100 + b'\n'
+               b'\\.\n')
+DUMP = HEAD + PARTNERS + MESSAGES + AUDIT + ATTACHMENTS
+
+
+def gzip(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def rows(block):
+    """A COPY block without its rows"""
+    lines = block.splitlines(True)
+    return lines[0] + lines[-1]
+
+
+class TestTableFilter(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.route('POST', '/database/v1/upload', self.upload)
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.tmp)
+
+    def upload(self, request):
+        return json_response({'request': {'id': 10042, 'state': 'draft'}})
+
+    def write_dump(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as fp:
+            fp.write(data)
+        return path
+
+    def filter(self, dump, *patterns):
+        argv = ['upload', '--key', 'key', '--request', '10042',
+                '--dbdump', dump]
+        for pattern in patterns:
+            argv += ['--exclude-table-data', pattern]
+        manager = UpgradeManager(make_args(self.server, *argv))
+        return manager, manager.dispatch()
+
+    def test_filter(self):
+        manager, exitcode = self.filter(
+            self.write_dump('db.sql', DUMP), 'public.mail_*', 'ir_attachment')
+        self.assertFalse(exitcode)
+        # the COPY statements are kept, without their rows. 'schema.table'
+        # patterns only match that schema, 'table' ones any schema:
+        self.assertEqual(self.server.requests[0].body,
+                         HEAD + PARTNERS + rows(MESSAGES) + AUDIT +
+                         rows(ATTACHMENTS))
+        self.assertEqual(manager.output['excluded_table_data'], {
+            'public.mail_message': 16,
+            'public.ir_attachment': 103,
+        })
+
+    def test_gzip(self):
+        # concatenated gzip members, as written by 'cat a.gz b.gz':
+        half = len(HEAD + PARTNERS) + 10
+        dump = self.write_dump(
+            'db.sql.gz', gzip(DUMP[:half]) + gzip(DUMP[half:]))
+        manager, exitcode = self.filter(dump, 'mail_message')
+        self.assertFalse(exitcode)
+        body = self.server.requests[0].body
+        self.assertTrue(body.startswith(b'\x1f\x8b'))
+        self.assertEqual(zlib.decompress(body, GZIP_WBITS),
+                         HEAD + PARTNERS + rows(MESSAGES) + rows(AUDIT) +
+                         ATTACHMENTS)
+        self.assertEqual(manager.output['excluded_table_data'], {
+            'public.mail_message': 16,
+            'audit.mail_message': 2,
+        })
+
+    def test_corrupt_gzip(self):
+        dump = self.write_dump('db.sql.gz', b'\x1f\x8b' + os.urandom(4096))
+        manager, exitcode = self.filter(dump, 'mail_message')
+        self.assertEqual(exitcode, ERROR_DUMP)
+
+    def test_custom_format(self):
+        dump = self.write_dump('db.dump', b'PGDMP\x01\x0e\x00' + DUMP)
+        manager, exitcode = self.filter(dump, 'mail_message')
+        self.assertEqual(exitcode, ERROR_DUMP)
+
+    def test_production(self):
+        manager = UpgradeManager(make_args(
+            self.server, 'all', '--contract', 'contract', '--email',
+            'john.doe@example.com', '--target', '12.0', '--aim', 'production',
+            '--dbdump', self.write_dump('db.sql', DUMP),
+            '--exclude-table-data', 'mail_message'))
+        with self.assertRaises(SystemExit) as cm:
+            manager.dispatch()
+        self.assertEqual(cm.exception.code, ERROR_MISSING_ARGUMENT)
+        self.assertEqual(self.server.requests, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,108 @@
+#-*- encoding: utf8 -*-
+
+import os
+import socket
+import tempfile
+import unittest
+
+import pycurl
+
+from odoo_upgrade import tuning
+from odoo_upgrade.odoo_upgrade import UpgradeManager
+
+from .standin import StandInServer, json_response, make_args
+
+
+# reading speed of the throttled stand-in server, in bytes per second:
+THROTTLE = 1024 * 1024
+
+
+class TestTune(unittest.TestCase):
+    def test_bdp(self):
+        # 100 Mbit/s, 80 ms: a 1 MB bandwidth-delay product
+        settings = tuning.tune(0.08, 12.5e6)
+        self.assertEqual(settings['sndbuf'], 2 * 1024 * 1024)
+
+    def test_bounds(self):
+        self.assertEqual(tuning.tune(0.0001, 1e3)['sndbuf'], tuning.MIN_SNDBUF)
+        self.assertEqual(tuning.tune(1, 1e9)['sndbuf'], tuning.MAX_SNDBUF)
+        self.assertEqual(tuning.tune(None, None),
+                         {'tcp_keepalive': tuning.TCP_KEEPALIVE})
+
+
+class TestAutotune(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer(throttle=THROTTLE)
+        self.server.route('POST', '/database/v1/upload', lambda request:
+                          json_response({'request': {'id': 10042}}))
+        self.dump = None
+        self.curl = pycurl.Curl()
+        self.measure = tuning.MEASURE_START, tuning.MEASURE_END
+        tuning.MEASURE_START, tuning.MEASURE_END = 0.5, 1.5
+
+    def tearDown(self):
+        tuning.MEASURE_START, tuning.MEASURE_END = self.measure
+        self.curl.close()
+        self.server.stop()
+        os.unlink(self.dump)
+
+    def upload(self, size, *argv):
+        fd, self.dump = tempfile.mkstemp(suffix='.sql')
+        os.write(fd, b'\0' * size)
+        os.close(fd)
+        manager = UpgradeManager(make_args(
+            self.server, 'upload', '--key', 'secret', '--request', '10042',
+            '--dbdump', self.dump, '--autotune', *argv), self.curl)
+        self.assertFalse(manager.dispatch())
+        # no test transfers, only the upload:
+        self.assertEqual([request.path for request in self.server.requests],
+                         ['/database/v1/upload'])
+        self.assertEqual(len(self.server.requests[0].body), size)
+        return manager.output['tuning']
+
+    def socket_option(self, level, option):
+        sock = socket.fromfd(self.curl.getinfo(pycurl.LASTSOCKET),
+                             socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            return sock.getsockopt(level, option)
+        finally:
+            sock.close()
+
+    @unittest.skipUnless(hasattr(socket, 'TCP_INFO'), "Linux only")
+    def test_throttled(self):
+        settings = self.upload(4 * THROTTLE)
+        # what the server read, not what the local buffers took:
+        self.assertTrue(THROTTLE / 2 < settings['throughput'] < THROTTLE * 2,
+                        settings['throughput'])
+        self.assertIsNotNone(settings['rtt'])
+        self.assertEqual(settings['sndbuf'], tuning.tune(
+            settings['rtt'], settings['throughput'])['sndbuf'])
+
+        # on a connection of its own, with its socket options:
+        self.assertEqual(self.curl.getinfo(pycurl.NUM_CONNECTS), 1)
+        self.assertEqual(
+            self.socket_option(socket.SOL_SOCKET, socket.SO_KEEPALIVE), 1)
+        self.assertEqual(
+            self.socket_option(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE),
+            tuning.TCP_KEEPALIVE)
+        # the kernel doubles the value, up to net.core.wmem_max:
+        self.assertGreaterEqual(
+            self.socket_option(socket.SOL_SOCKET, socket.SO_SNDBUF),
+            min(settings['sndbuf'], tuning.MIN_SNDBUF))
+
+    @unittest.skipUnless(hasattr(socket, 'TCP_INFO'), "Linux only")
+    def test_explicit_sndbuf(self):
+        settings = self.upload(4 * THROTTLE, '--sndbuf', '131072')
+        self.assertIsNotNone(settings['throughput'])
+        self.assertEqual(settings['sndbuf'], 131072)
+
+    def test_short_upload(self):
+        # over before the end of the measure: the defaults are kept
+        settings = self.upload(1000)
+        self.assertIsNone(settings['throughput'])
+        self.assertNotIn('sndbuf', settings)
+        self.assertEqual(settings['tcp_keepalive'], tuning.TCP_KEEPALIVE)
+
+
+if __name__ == '__main__':
+    unittest.main()